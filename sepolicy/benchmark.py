@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import json
+import random
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Set, Tuple
+
+from cil_rule import CilRule
+from classmap import SELINUX_INCLUDE_PATH, Classmap
+from conditional_type import ConditionalType
+from config import default_variables
+from decompile_cil import (
+    DecompiledMacros,
+    MacroArtefacts,
+    decompile_cil,
+    read_cil_lines,
+)
+from macro_stats import MacroStatsCollector
+from match import (
+    match_all_macro_rules,
+    merge_class_sets,
+    replace_macro_rules,
+    replace_perms,
+)
+from mld import MultiLevelDict
+from output import group_rules, output_grouped_rules
+from profiler import PhaseProfiler
+from rule import RULE_DYNAMIC_PARTS_INDEX, Rule
+from utils import LOG_LEVELS, process_pool, setup_logging
+
+BENCHMARK_POLICY_VERSION = '30.0'
+BENCHMARK_PHASES = [
+    'cil_parse',
+    'from_line',
+    'mld_add',
+    'mld_match',
+    'macro_matching',
+    'macro_replace',
+    'replace_perms',
+    'merge_class_sets',
+    'output',
+]
+
+
+class BenchmarkConfig:
+    def __init__(
+        self,
+        types: int,
+        attributes: int,
+        allow_rules: int,
+        macros: int,
+        macro_rules: int,
+        macro_args: int,
+        macro_calls: int,
+        classes: int,
+        class_perms: int,
+        seed: int,
+    ):
+        # Number of file types and plain allow rules of each domain
+        self.types = types
+        self.allow_rules = allow_rules
+        # Number of attributes shared by all domains
+        self.attributes = attributes
+        # Number of macros, rules inside each macro, args of each macro and
+        # number of macros called by each domain
+        self.macros = macros
+        self.macro_rules = macro_rules
+        self.macro_args = macro_args
+        self.macro_calls = macro_calls
+        self.classes = classes
+        self.class_perms = class_perms
+        self.seed = seed
+
+
+def class_name(index: int):
+    # replace_perms only replaces perms of classes ending with file
+    return f'bench_{index}_file'
+
+
+def perm_name(index: int):
+    return f'perm_{index}'
+
+
+def domain_name(index: int):
+    return f'bench_domain_{index}'
+
+
+def file_type_name(domain: str, index: int):
+    return f'{domain}_file_{index}'
+
+
+def random_perms(rng: random.Random, config: BenchmarkConfig):
+    count = rng.randint(1, min(4, config.class_perms))
+    return sorted(rng.sample(range(config.class_perms), count))
+
+
+class BenchmarkMacros:
+    def __init__(self, config: BenchmarkConfig):
+        rng = random.Random(config.seed)
+
+        # Sets of perms and classes used to test replace_perms and
+        # merge_class_sets
+        self.perms: List[List[int]] = [
+            sorted(rng.sample(range(config.class_perms), 3))
+            for _ in range(config.macros)
+        ]
+        self.class_sets: List[List[int]] = [
+            sorted(rng.sample(range(config.classes), 2))
+            for _ in range(config.macros)
+        ]
+
+        # Each macro rule is a class index, the arg index of the source,
+        # the arg index and file type index of the target and perms
+        self.macros: List[List[Tuple[int, int, int, int, List[int]]]] = []
+        for _ in range(config.macros):
+            macro_rules: List[Tuple[int, int, int, int, List[int]]] = []
+            for i in range(config.macro_rules):
+                macro_rules.append(
+                    (
+                        rng.randrange(config.classes),
+                        1,
+                        1 + i % config.macro_args,
+                        rng.randrange(config.types),
+                        random_perms(rng, config),
+                    )
+                )
+            self.macros.append(macro_rules)
+
+    def text(self):
+        lines: List[str] = []
+
+        for i, perms in enumerate(self.perms):
+            perms_str = ' '.join(map(perm_name, perms))
+            lines.append(f"define(`bench_{i}_file_perms', `{{ {perms_str} }}')")
+
+        for i, classes in enumerate(self.class_sets):
+            classes_str = ' '.join(map(class_name, classes))
+            lines.append(
+                f"define(`bench_{i}_class_set', `{{ {classes_str} }}')"
+            )
+
+        for i, macro_rules in enumerate(self.macros):
+            lines.append(f"define(`bench_macro_{i}', `")
+            for c, s, t, f, perms in macro_rules:
+                perms_str = ' '.join(map(perm_name, perms))
+                lines.append(
+                    f'allow ${s} ${t}_file_{f}:{class_name(c)} '
+                    f'{{ {perms_str} }};'
+                )
+            lines.append("')")
+
+        return '\n'.join(lines) + '\n'
+
+
+def classmap_text(config: BenchmarkConfig):
+    lines = ['const struct security_class_mapping secclass_map[] = {']
+    for i in range(config.classes):
+        perms = ', '.join(
+            f'"{perm_name(j)}"' for j in range(config.class_perms)
+        )
+        lines.append(f'\t{{ "{class_name(i)}", {{ {perms}, NULL }} }},')
+    lines.append('\t{ NULL }')
+    lines.append('};')
+
+    return '\n'.join(lines) + '\n'
+
+
+def cil_allow(source: str, target: str, c: int, perms: List[int]):
+    perms_str = ' '.join(map(perm_name, perms))
+    return f'(allow {source} {target} ({class_name(c)} ({perms_str})))'
+
+
+def vendor_cil_text(
+    config: BenchmarkConfig,
+    macros: BenchmarkMacros,
+    domains: int,
+):
+    rng = random.Random(config.seed + domains)
+    names = [domain_name(i) for i in range(domains)]
+    lines: List[str] = []
+
+    for i in range(config.attributes):
+        lines.append(f'(typeattribute bench_attr_{i})')
+
+    for i, d in enumerate(names):
+        lines.append(f'(type {d})')
+        lines.append(f'(typeattributeset domain ({d}))')
+        if config.attributes:
+            attribute = f'bench_attr_{i % config.attributes}'
+            lines.append(f'(typeattributeset {attribute} ({d}))')
+
+        for j in range(config.types):
+            t = file_type_name(d, j)
+            lines.append(f'(type {t})')
+            lines.append(f'(typeattributeset file_type ({t}))')
+
+    for d in names:
+        for _ in range(config.allow_rules):
+            target = file_type_name(
+                rng.choice(names),
+                rng.randrange(config.types),
+            )
+            c = rng.randrange(config.classes)
+            # Use the perms of a perms macro half of the time
+            if macros.perms and rng.random() < 0.5:
+                perms = rng.choice(macros.perms)
+            else:
+                perms = random_perms(rng, config)
+            lines.append(cil_allow(d, target, c, perms))
+
+        # Allow the same perms on all the classes of a class set
+        if macros.class_sets:
+            classes = rng.choice(macros.class_sets)
+            target = file_type_name(d, rng.randrange(config.types))
+            perms = random_perms(rng, config)
+            for c in classes:
+                lines.append(cil_allow(d, target, c, perms))
+
+        for _ in range(min(config.macro_calls, len(macros.macros))):
+            macro_rules = rng.choice(macros.macros)
+            args = [d] + [
+                rng.choice(names) for _ in range(config.macro_args - 1)
+            ]
+            for c, s, t, f, perms in macro_rules:
+                target = file_type_name(args[t - 1], f)
+                lines.append(cil_allow(args[s - 1], target, c, perms))
+
+    return '\n'.join(lines) + '\n'
+
+
+def benchmark_size(
+    vendor_cil_path: str,
+    output_dir: str,
+    classmap: Classmap,
+    macros: DecompiledMacros,
+):
+    profiler = PhaseProfiler()
+
+    with profiler.phase('cil_parse'):
+        conditional_types_map: Dict[str, ConditionalType] = {}
+        missing_generated_types: Set[str] = set()
+        genfs_rules: List[Rule] = []
+        rules = list(
+            decompile_cil(
+                vendor_cil_path,
+                conditional_types_map,
+                missing_generated_types,
+                genfs_rules,
+                BENCHMARK_POLICY_VERSION,
+            )
+        )
+
+    # Time the conversion of lines to rules on its own, without reading the
+    # file and loading the conditional types, which cil_parse also does
+    lines = list(read_cil_lines(vendor_cil_path))
+    with profiler.phase('from_line'):
+        for line in lines:
+            CilRule.from_line(
+                line,
+                conditional_types_map,
+                set(),
+                [],
+                BENCHMARK_POLICY_VERSION,
+            )
+
+    with profiler.phase('mld_add'):
+        mld: MultiLevelDict[Rule] = MultiLevelDict()
+        for rule in rules:
+            mld.add(rule.hash_values, rule, RULE_DYNAMIC_PARTS_INDEX)
+
+    with profiler.phase('mld_match'):
+        # Look up rules by everything but their target, the same way
+        # macro rules with a filled source arg are looked up
+        for rule in rules:
+            keys = list(rule.hash_values)
+            keys[RULE_DYNAMIC_PARTS_INDEX + 1] = None
+            for _ in mld.match(keys):
+                pass
+
+    with profiler.phase('macro_matching'):
+        macros_rule_matches = match_all_macro_rules(
+            mld,
+            macros.macros_name_rules,
+            MacroStatsCollector(),
+        )
+
+    with profiler.phase('macro_replace'):
+        all_rule_matches = set()
+        for rule_matches in macros_rule_matches.values():
+            all_rule_matches.update(rule_matches)
+
+        replace_macro_rules(mld, all_rule_matches)
+
+    with profiler.phase('replace_perms'):
+        replace_perms(mld, classmap, macros.perms)
+
+    with profiler.phase('merge_class_sets'):
+        merge_class_sets(mld, macros.class_sets)
+
+    with profiler.phase('output'):
+        grouped_rules = group_rules(mld)
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        output_grouped_rules(grouped_rules, output_dir)
+
+    report = profiler.report()
+    report['rules'] = len(rules)
+
+    return report
+
+
+def print_scaling_table(
+    reports: List[Tuple[int, Dict]],
+    key: str,
+    title: str,
+    scale: float,
+):
+    print(title)
+    header = ' '.join(f'{phase:>16}' for phase in BENCHMARK_PHASES)
+    print(f'{"domains":>10} {"rules":>10} {header}')
+    for domains, report in reports:
+        phases = {p['name']: p for p in report['phases']}
+        values = ' '.join(
+            f'{phases[phase][key] / scale:>16.3f}' for phase in BENCHMARK_PHASES
+        )
+        print(f'{domains:>10} {report["rules"]:>10} {values}')
+    print()
+
+
+def run_benchmark(
+    config: BenchmarkConfig,
+    sizes: List[int],
+    work_dir: str,
+    report_path: Optional[str],
+):
+    macros = BenchmarkMacros(config)
+
+    include_path = Path(work_dir, 'kernel', SELINUX_INCLUDE_PATH)
+    include_path.mkdir(parents=True)
+    Path(include_path, 'classmap.h').write_text(classmap_text(config))
+
+    macros_path = Path(work_dir, 'te_macros')
+    macros_path.write_text(macros.text())
+
+    setup_profiler = PhaseProfiler()
+
+    with setup_profiler.phase('classmap'):
+        classmap = Classmap(str(include_path))
+
+    with setup_profiler.phase('macro_read'):
+        artefacts = MacroArtefacts([str(macros_path)], classmap, None)
+
+    decompiled_macros = artefacts.decompiled_macros(
+        default_variables.copy(),
+        setup_profiler,
+    )
+
+    reports: List[Tuple[int, Dict]] = []
+    for domains in sizes:
+        size_dir = Path(work_dir, f'domains_{domains}')
+        size_dir.mkdir()
+
+        vendor_cil_path = Path(size_dir, 'vendor_sepolicy.cil')
+        vendor_cil_path.write_text(vendor_cil_text(config, macros, domains))
+
+        # Run each size in a new process so that the peak memory usage of
+        # the previous sizes does not hide the one of the current size
+        with process_pool(1) as e:
+            future = e.submit(
+                benchmark_size,
+                str(vendor_cil_path),
+                str(Path(size_dir, 'output')),
+                classmap,
+                decompiled_macros,
+            )
+            reports.append((domains, future.result()))
+
+    print_scaling_table(reports, 'wall_time', 'Wall time (s)', 1)
+    print_scaling_table(
+        reports,
+        'peak_rss_so_far',
+        'Peak RSS reached by the end of each phase (MiB)',
+        1024 * 1024,
+    )
+
+    if report_path is not None:
+        with open(report_path, 'w') as file:
+            json.dump(
+                {
+                    'setup': setup_profiler.report(),
+                    'sizes': [
+                        {'domains': domains, **report}
+                        for domains, report in reports
+                    ],
+                },
+                file,
+                indent=4,
+            )
+            file.write('\n')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        prog='benchmark.py',
+        description='Benchmark the decompiler on synthetic policies',
+    )
+    parser.add_argument(
+        '--sizes',
+        action='store',
+        default='100,200,400,800',
+        help='Comma separated numbers of domains to benchmark',
+    )
+    parser.add_argument(
+        '--types',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of file types of each domain',
+    )
+    parser.add_argument(
+        '--attributes',
+        action='store',
+        type=int,
+        default=16,
+        help='Number of attributes shared by the domains',
+    )
+    parser.add_argument(
+        '--allow-rules',
+        action='store',
+        type=int,
+        default=20,
+        help='Number of allow rules of each domain outside of macros',
+    )
+    parser.add_argument(
+        '--macros',
+        action='store',
+        type=int,
+        default=32,
+        help='Number of macros',
+    )
+    parser.add_argument(
+        '--macro-rules',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of rules of each macro',
+    )
+    parser.add_argument(
+        '--macro-args',
+        action='store',
+        type=int,
+        default=2,
+        help='Number of args of each macro',
+    )
+    parser.add_argument(
+        '--macro-calls',
+        action='store',
+        type=int,
+        default=4,
+        help='Number of macros called by each domain',
+    )
+    parser.add_argument(
+        '--classes',
+        action='store',
+        type=int,
+        default=16,
+        help='Number of classes in the classmap',
+    )
+    parser.add_argument(
+        '--class-perms',
+        action='store',
+        type=int,
+        default=24,
+        help='Number of perms of each class',
+    )
+    parser.add_argument(
+        '--seed',
+        action='store',
+        type=int,
+        default=0,
+        help='Seed used to generate the policies',
+    )
+    parser.add_argument(
+        '--work-dir',
+        action='store',
+        help='Directory to generate the policies into, kept after the run',
+    )
+    parser.add_argument(
+        '--report',
+        action='store',
+        help='Write the time and memory used by each phase to a JSON file',
+    )
+    # The random macro calls of the synthetic policies overlap, which
+    # warns about every rule that is already removed
+    parser.add_argument(
+        '--log-level',
+        action='store',
+        choices=list(LOG_LEVELS.keys()),
+        default='error',
+        help='Minimum level of the messages to print',
+    )
+
+    args = parser.parse_args()
+
+    setup_logging(LOG_LEVELS[args.log_level])
+
+    config = BenchmarkConfig(
+        args.types,
+        args.attributes,
+        args.allow_rules,
+        args.macros,
+        args.macro_rules,
+        args.macro_args,
+        args.macro_calls,
+        args.classes,
+        args.class_perms,
+        args.seed,
+    )
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    if args.work_dir is not None:
+        run_benchmark(config, sizes, args.work_dir, args.report)
+    else:
+        with TemporaryDirectory() as work_dir:
+            run_benchmark(config, sizes, work_dir, args.report)
@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Optional
+
+CACHE_DIR_NAME = 'android_tools_sepolicy'
+FILE_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = str(Path(Path.home(), '.cache'))
+
+    return str(Path(cache_home, CACHE_DIR_NAME))
+
+
+def file_digest(path: str):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(FILE_DIGEST_CHUNK_SIZE):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def text_digest(*values: str):
+    h = hashlib.sha256()
+    for value in values:
+        # Separate the values so that moving characters from one value to
+        # the next one results in a different digest
+        h.update(value.encode())
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+
+def write_bytes_atomic(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary file and rename it to make the file appear
+    # atomically for concurrent runs
+    with NamedTemporaryFile(dir=path.parent, delete=False) as file:
+        file.write(data)
+
+    os.replace(file.name, path)
+
+
+class Cache:
+    def __init__(self, cache_dir: str):
+        self.__cache_dir = cache_dir
+
+    def __path(self, namespace: str, key: str):
+        return Path(self.__cache_dir, namespace, key)
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        path = self.__path(namespace, key)
+
+        try:
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def put(self, namespace: str, key: str, data: bytes):
+        write_bytes_atomic(self.__path(namespace, key), data)
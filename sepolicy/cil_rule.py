@@ -3,10 +3,12 @@
 
 from __future__ import annotations
 
+import logging
 from enum import Enum
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple, Union
 
-from conditional_type import ConditionalType, ConditionalTypeRedirect
+from conditional_type import ConditionalType
+from ioctl_set import IoctlSet, parse_ioctl
 from rule import (
     Rule,
     RuleType,
@@ -28,6 +30,14 @@ def remove_type_suffix(suffix: Optional[str], t: str):
     return t
 
 
+def version_type_suffix(version: Optional[str]):
+    if version is None:
+        return None
+
+    version = version.replace('.', '_')
+    return f'_{version}'
+
+
 def is_conditional_typeattr(part: raw_part):
     if isinstance(part[0], list):
         part = part[0][0]
@@ -74,7 +84,12 @@ def create_conditional_type(
 
     # Split in groups of two
     if len(parts) not in [2, 4]:
-        color_print('Ignored conditional type: ', parts, color=Color.YELLOW)
+        color_print(
+            'Ignored conditional type: ',
+            parts,
+            color=Color.YELLOW,
+            level=logging.WARNING,
+        )
         return None
 
     positive: List[str] = []
@@ -94,7 +109,12 @@ def create_conditional_type(
                 new_group.append(t)
                 continue
 
-            color_print('Ignored conditional type: ', parts, color=Color.YELLOW)
+            color_print(
+                'Ignored conditional type: ',
+                parts,
+                color=Color.YELLOW,
+                level=logging.WARNING,
+            )
             return None
 
         new_types = map(
@@ -137,7 +157,8 @@ def unpack_ioctls(parts: raw_parts_list):
 
     for part in parts:
         if isinstance(part, str):
-            yield part
+            ioctl = parse_ioctl(part)
+            yield ioctl, ioctl
             continue
 
         assert isinstance(part, list)
@@ -148,13 +169,12 @@ def unpack_ioctls(parts: raw_parts_list):
         assert part[0] == 'range'
 
         assert isinstance(part[1], str)
-        start_ioctl = int(part[1], base=16)
+        start_ioctl = parse_ioctl(part[1])
 
         assert isinstance(part[2], str)
-        end_ioctl = int(part[2], base=16)
+        end_ioctl = parse_ioctl(part[2])
 
-        for n in range(start_ioctl, end_ioctl + 1):
-            yield hex(n)
+        yield start_ioctl, end_ioctl
 
 
 class CilRuleType(str, Enum):
@@ -200,7 +220,57 @@ unknown_rule_types: Set[str] = set(
 )
 
 
+TYPEATTRIBUTESET_LINE_PREFIX = f'({CilRuleType.TYPEATTRIBUTESET.value} '
+
+
+def resolve_generated_type(
+    t: str,
+    conditional_types_map: Dict[str, ConditionalType],
+    missing_generated_types: Set[str],
+) -> Union[str, ConditionalType]:
+    # Conditional types are fully gathered before any rule is created,
+    # resolve generated types right away so that rules only hold plain
+    # values, keep the name of the ones that cannot be found
+    # Missing types are reported by the caller once all the rules are
+    # parsed, to report them once even when parsing in parallel
+    conditional_type = conditional_types_map.get(t)
+    if conditional_type is not None:
+        return conditional_type
+
+    missing_generated_types.add(t)
+
+    return t
+
+
 class CilRule(Rule):
+    __slots__ = ()
+
+    @classmethod
+    def conditional_type_from_line(
+        cls,
+        line: str,
+        version: Optional[str],
+    ) -> Optional[Tuple[str, ConditionalType]]:
+        # Avoid unpacking lines that cannot define a conditional type
+        if not line.startswith(TYPEATTRIBUTESET_LINE_PREFIX):
+            return None
+
+        parts = unpack_line(line, '(', ')', ' ')
+        assert isinstance(parts[1], str), line
+
+        if not is_conditional_typeattr(parts[2]):
+            return None
+
+        assert isinstance(parts[2], list)
+
+        version_suffix = version_type_suffix(version)
+        conditional_type = create_conditional_type(version_suffix, parts[2])
+        if conditional_type is None:
+            return None
+
+        v = remove_type_suffix(version_suffix, parts[1])
+        return v, conditional_type
+
     @classmethod
     def from_line(
         cls,
@@ -211,16 +281,13 @@ class CilRule(Rule):
         version: Optional[str],
     ) -> List[Rule]:
         def type_redirect(t: str):
-            return ConditionalTypeRedirect(
+            return resolve_generated_type(
                 t,
                 conditional_types_map,
                 missing_generated_types,
             )
 
-        version_suffix = None
-        if version is not None:
-            version = version.replace('.', '_')
-            version_suffix = f'_{version}'
+        version_suffix = version_type_suffix(version)
 
         # Skip comments and empty lines
         if not is_valid_cil_line(line):
@@ -293,8 +360,9 @@ class CilRule(Rule):
                 assert isinstance(parts[3][1], str), line
                 assert isinstance(parts[3][2], list), line
 
-                for ioctl in unpack_ioctls(parts[3][2]):
-                    varargs.append(ioctl)
+                # Keep ranges as they are instead of expanding them
+                ioctl_set = IoctlSet(unpack_ioctls(parts[3][2]))
+                varargs.extend(ioctl_set.to_strs())
 
                 src = remove_type_suffix(version_suffix, parts[1])
                 if is_type_generated(src):
@@ -343,20 +411,10 @@ class CilRule(Rule):
                 assert isinstance(parts[1], str), line
                 v = remove_type_suffix(version_suffix, parts[1])
 
-                # Process conditional types and add them to a map to be replaced
-                # into the other rules later
+                # Conditional types are gathered into a map by a separate
+                # pass using conditional_type_from_line() before any rule
+                # is created, to be replaced into the other rules later
                 if is_conditional_typeattr(parts[2]):
-                    assert isinstance(parts[2], list)
-
-                    conditional_type = create_conditional_type(
-                        version_suffix,
-                        parts[2],
-                    )
-                    if conditional_type is None:
-                        return []
-
-                    assert v not in conditional_types_map
-                    conditional_types_map[v] = conditional_type
                     return []
 
                 # Expand typeattributeset into multiple typeattribute rules
@@ -4,14 +4,32 @@
 from __future__ import annotations
 
 import json
+import re
 import subprocess
+from enum import Enum
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from cache import Cache, file_digest, text_digest
 
 SELINUX_INCLUDE_PATH = 'security/selinux/include/'
 SCRIPT_PATH = Path(__file__).parent.resolve()
 CLASSMAP_GENERATOR_C_PATH = Path(SCRIPT_PATH, 'classmap_generator.c')
+CLASSMAP_H_NAME = 'classmap.h'
+CLASSMAP_CACHE = 'classmap_v1'
+
+initializer_value = Union[str, None, List['initializer_value']]
+
+c_comment_regex = re.compile(r'/\*.*?\*/|//[^\n]*', re.DOTALL)
+c_define_regex = re.compile(r'^[ \t]*#[ \t]*define[ \t]+(\w+)[ \t]+(.*)$', re.M)
+c_token_regex = re.compile(r'"((?:[^"\\]|\\.)*)"|(\w+)|([{},])|(\S)')
+secclass_map_regex = re.compile(r'\bsecclass_map\s*\[\s*\]\s*=')
+
+
+class ClassmapExtractor(str, Enum):
+    GCC = 'gcc'
+    PYTHON = 'python'
 
 
 def extract_classmap(selinux_include_path: str):
@@ -37,15 +55,174 @@ def extract_classmap(selinux_include_path: str):
         return json.loads(program_output)
 
 
+def tokenize_c(text: str):
+    tokens: List[Tuple[str, str]] = []
+
+    for m in c_token_regex.finditer(text):
+        string, identifier, punctuation, other = m.groups()
+
+        if string is not None:
+            # Concatenate adjacent string literals
+            if tokens and tokens[-1][0] == 'string':
+                string = tokens.pop()[1] + string
+            tokens.append(('string', string))
+        elif identifier is not None:
+            tokens.append(('identifier', identifier))
+        elif punctuation is not None:
+            tokens.append(('punctuation', punctuation))
+        else:
+            tokens.append(('punctuation', other))
+
+    return tokens
+
+
+def expand_c_defines(
+    tokens: List[Tuple[str, str]],
+    defines: Dict[str, List[Tuple[str, str]]],
+) -> List[Tuple[str, str]]:
+    expanded_tokens: List[Tuple[str, str]] = []
+
+    for token in tokens:
+        kind, value = token
+        if kind == 'identifier' and value in defines:
+            expanded_tokens.extend(expand_c_defines(defines[value], defines))
+        else:
+            expanded_tokens.append(token)
+
+    return expanded_tokens
+
+
+def parse_c_initializer(
+    tokens: List[Tuple[str, str]],
+    index: int,
+) -> Tuple[initializer_value, int]:
+    kind, value = tokens[index]
+
+    if kind == 'string':
+        return value, index + 1
+
+    if kind == 'identifier':
+        if value != 'NULL':
+            raise ValueError(f'Unknown identifier in classmap: {value}')
+
+        return None, index + 1
+
+    if value != '{':
+        raise ValueError(f'Unexpected token in classmap: {value}')
+
+    values: List[initializer_value] = []
+    index += 1
+    while tokens[index] != ('punctuation', '}'):
+        current_value, index = parse_c_initializer(tokens, index)
+        values.append(current_value)
+
+        if tokens[index] == ('punctuation', ','):
+            index += 1
+
+    return values, index + 1
+
+
+def parse_classmap(selinux_include_path: str):
+    # Parse the secclass_map initializer out of classmap.h without running
+    # the preprocessor, only the #define directives used to share perms
+    # between classes are supported
+    classmap_path = Path(selinux_include_path, CLASSMAP_H_NAME)
+    text = classmap_path.read_text()
+    text = c_comment_regex.sub(' ', text)
+    text = text.replace('\\\n', ' ')
+
+    defines: Dict[str, List[Tuple[str, str]]] = {}
+    for m in c_define_regex.finditer(text):
+        defines[m.group(1)] = tokenize_c(m.group(2))
+
+    secclass_map_match = secclass_map_regex.search(text)
+    if secclass_map_match is None:
+        raise ValueError(f'secclass_map not found in {classmap_path}')
+
+    tokens = tokenize_c(text[secclass_map_match.end() :])
+    tokens = expand_c_defines(tokens, defines)
+    secclass_map, _ = parse_c_initializer(tokens, 0)
+    assert isinstance(secclass_map, list)
+
+    class_perms_map: Dict[str, List[str]] = {}
+    for class_mapping in secclass_map:
+        assert isinstance(class_mapping, list)
+
+        class_name = class_mapping[0]
+        if class_name is None:
+            break
+
+        assert isinstance(class_name, str)
+        assert isinstance(class_mapping[1], list)
+
+        perms: List[str] = []
+        for perm in class_mapping[1]:
+            if perm is None:
+                break
+
+            assert isinstance(perm, str)
+            perms.append(perm)
+
+        class_perms_map[class_name] = perms
+
+    return class_perms_map
+
+
+def headers_digest(selinux_include_path: str):
+    values: List[str] = [file_digest(str(CLASSMAP_GENERATOR_C_PATH))]
+
+    for path in sorted(Path(selinux_include_path).rglob('*')):
+        if not path.is_file():
+            continue
+
+        values.append(str(path.relative_to(selinux_include_path)))
+        values.append(file_digest(str(path)))
+
+    return text_digest(*values)
+
+
+def extract_classmap_cached(
+    selinux_include_path: str,
+    cache: Optional[Cache],
+) -> Dict[str, List[str]]:
+    if cache is None:
+        return extract_classmap(selinux_include_path)
+
+    key = headers_digest(selinux_include_path)
+    data = cache.get(CLASSMAP_CACHE, key)
+    if data is not None:
+        return json.loads(data)
+
+    class_perms_map = extract_classmap(selinux_include_path)
+    cache.put(CLASSMAP_CACHE, key, json.dumps(class_perms_map).encode())
+
+    return class_perms_map
+
+
 class Classmap:
-    def __init__(self, selinux_include_path: str):
-        class_perms_map = extract_classmap(selinux_include_path)
+    def __init__(
+        self,
+        selinux_include_path: str,
+        cache: Optional[Cache] = None,
+        extractor: ClassmapExtractor = ClassmapExtractor.GCC,
+    ):
+        if extractor == ClassmapExtractor.PYTHON:
+            class_perms_map = parse_classmap(selinux_include_path)
+        else:
+            class_perms_map = extract_classmap_cached(
+                selinux_include_path,
+                cache,
+            )
 
         self.__class_index_map: Dict[str, int] = {}
         self.__class_perms_index_map: Dict[str, Dict[str, int]] = {}
+        self.__class_perms_map: Dict[str, List[str]] = {}
 
         for index, class_name in enumerate(class_perms_map.keys()):
             self.__class_index_map[class_name] = index
+            self.__class_perms_map[class_name] = list(
+                class_perms_map[class_name]
+            )
 
             for perm_index, perm_name in enumerate(class_perms_map[class_name]):
                 self.__class_perms_index_map.setdefault(class_name, {})
@@ -59,6 +236,38 @@ class Classmap:
     def class_perms(self, class_name: str):
         return list(self.__class_perms_index_map[class_name].keys())
 
+    def perms_mask(self, class_name: str, perms: Iterable[str]):
+        # Bit i of the mask is set if the perm with index i is in perms,
+        # perms that are not part of the class are returned separately
+        perms_map = self.__class_perms_index_map.get(class_name, {})
+
+        mask = 0
+        extra_perms: Set[str] = set()
+        for perm in perms:
+            perm_index = perms_map.get(perm)
+            if perm_index is None:
+                extra_perms.add(perm)
+            else:
+                mask |= 1 << perm_index
+
+        return mask, extra_perms
+
+    def all_perms_mask(self, class_name: str):
+        perms_map = self.__class_perms_index_map.get(class_name, {})
+        return (1 << len(perms_map)) - 1
+
+    def mask_perms(self, class_name: str, mask: int):
+        perms = self.__class_perms_map.get(class_name, [])
+
+        # Only visit the set bits
+        mask_perms: List[str] = []
+        while mask:
+            bit = mask & -mask
+            mask_perms.append(perms[bit.bit_length() - 1])
+            mask ^= bit
+
+        return mask_perms
+
     def class_index(self, class_name: str):
         default = len(self.__class_index_map)
         return self.__class_index_map.get(class_name, default)
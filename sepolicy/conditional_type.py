@@ -4,12 +4,12 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import Dict, Hashable, List, Set
-
-from utils import Color, color_print
+from typing import Hashable, Iterable, Optional, Tuple
 
 
 class IConditionalType(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def __eq__(self, other: object) -> bool: ...
 
@@ -29,30 +29,69 @@ class IConditionalType(ABC):
 
     @property
     @abstractmethod
-    def positive(self) -> List[str]: ...
+    def positive(self) -> Tuple[str, ...]: ...
 
     @property
     @abstractmethod
-    def negative(self) -> List[str]: ...
+    def negative(self) -> Tuple[str, ...]: ...
 
     @property
     @abstractmethod
     def is_all(self) -> bool: ...
 
 
+def format_conditional_type(
+    positive: Tuple[str, ...],
+    negative: Tuple[str, ...],
+    is_all: bool,
+):
+    if is_all:
+        return '*'
+
+    if positive:
+        values = list(positive)
+        values.extend(f'-{v}' for v in negative)
+        return f'{{ {" ".join(values)} }}'
+
+    if not negative:
+        return ''
+
+    if len(negative) > 1:
+        return f'~{{ {" ".join(negative)} }}'
+
+    return f'~ {negative[0]}'
+
+
 class ConditionalType(IConditionalType):
-    def __init__(self, positive: List[str], negative: List[str], is_all: bool):
-        self.__positive = positive
-        self.__negative = negative
+    __slots__ = (
+        '__positive',
+        '__negative',
+        '__is_all',
+        '__hash_values',
+        '__hash',
+        '__str',
+    )
+
+    def __init__(
+        self,
+        positive: Iterable[str],
+        negative: Iterable[str],
+        is_all: bool,
+    ):
+        # Conditional types are shared between rules and used as keys,
+        # keep them immutable
+        self.__positive = tuple(positive)
+        self.__negative = tuple(negative)
         self.__is_all = is_all
         self.__hash_values = tuple(
             [
-                frozenset(positive),
-                frozenset(negative),
+                frozenset(self.__positive),
+                frozenset(self.__negative),
                 is_all,
             ],
         )
         self.__hash = hash(self.__hash_values)
+        self.__str: Optional[str] = None
 
     @property
     def hash(self):
@@ -75,6 +114,9 @@ class ConditionalType(IConditionalType):
         return self.__is_all
 
     def __eq__(self, other: object):
+        if self is other:
+            return True
+
         if not isinstance(other, IConditionalType):
             return False
 
@@ -87,106 +129,11 @@ class ConditionalType(IConditionalType):
         return self.__hash
 
     def __str__(self):
-        if self.__is_all:
-            return '*'
-
-        s = ''
-        if self.__positive:
-            s += '{'
-            for v in self.__positive:
-                s += f' {v}'
-            for v in self.__negative:
-                s += f' -{v}'
-            s += ' }'
-        elif self.__negative:
-            s += '~'
-
-            if len(self.__negative) > 1:
-                s += '{'
-            for v in self.__negative:
-                s += f' {v}'
-            if len(self.__negative) > 1:
-                s += ' }'
-
-        return s
-
-
-class ConditionalTypeRedirect(IConditionalType):
-    def __init__(self, t: str, m: Dict[str, ConditionalType], i: Set[str]):
-        self.__t = t
-        self.__m = m
-        self.__i = i
-
-    # TODO: is it necessary to do comparisons by actual value, or is it
-    # enough to compare the generated type name
-
-    def __get_c(self):
-        if self.__t not in self.__m:
-            if self.__t not in self.__i:
-                color_print(
-                    f'Generated type {self.__t} not found',
-                    color=Color.YELLOW,
-                )
-                self.__i.add(self.__t)
-            return None
-
-        return self.__m[self.__t]
-
-    @property
-    def hash(self):
-        c = self.__get_c()
-        if c is None:
-            assert False
-        return c.hash
-
-    @property
-    def hash_values(self) -> Hashable:
-        c = self.__get_c()
-        if c is None:
-            assert False
-        return c.hash_values
-
-    @property
-    def positive(self) -> List[str]:
-        c = self.__get_c()
-        if c is None:
-            return []
-
-        return c.positive
-
-    @property
-    def negative(self) -> List[str]:
-        c = self.__get_c()
-        if c is None:
-            return []
-
-        return c.positive
-
-    @property
-    def is_all(self):
-        c = self.__get_c()
-        if c is None:
-            return False
-
-        return c.is_all
-
-    def __eq__(self, other: object):
-        c = self.__get_c()
-        if c is None:
-            return self.__t == other
-
-        return c == other
-
-    def __hash__(self):
-        c = self.__get_c()
-        if c is None:
-            return hash(self.__t)
-
-        return hash(c)
-
-    def __str__(self):
-        c = self.__get_c()
-        if c is None:
-            return self.__t
-
-        return str(c)
+        if self.__str is None:
+            self.__str = format_conditional_type(
+                self.__positive,
+                self.__negative,
+                self.__is_all,
+            )
+
+        return self.__str
@@ -4,18 +4,30 @@
 
 from __future__ import annotations
 
+import logging
 import os
+import pickle
 import shutil
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
 from functools import partial
 from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Tuple
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple
 
+from cache import Cache, default_cache_dir, file_digest, text_digest
 from cil_rule import CilRule
-from classmap import SELINUX_INCLUDE_PATH, Classmap
+from classmap import SELINUX_INCLUDE_PATH, Classmap, ClassmapExtractor
 from conditional_type import ConditionalType
 from config import get_default_variables
+from incremental import match_all_macro_rules_incremental
+from ioctl_set import IoctlSet
 from macro import (
     categorize_macros,
     decompile_ioctl_defines,
@@ -29,9 +41,10 @@ from macro import (
     resolve_macro_paths,
     split_macros_text_name_body,
 )
+from macro_stats import MacroStatsCollector
 from match import (
     RuleMatch,
-    match_macro_rules,
+    match_all_macro_rules,
     merge_class_sets,
     merge_ioctl_rules,
     merge_typeattribute_rules,
@@ -43,17 +56,25 @@ from match_extract import rule_extract_part_iter
 from mld import MultiLevelDict
 from output import (
     group_rules,
-    output_contexts,
-    output_genfs_contexts,
-    output_grouped_rules,
+    output_policy,
+    remove_stale_outputs,
 )
+from profiler import PhaseProfiler
 from rule import RULE_DYNAMIC_PARTS_INDEX, Rule
-from utils import Color, color_print
+from utils import (
+    LOG_LEVELS,
+    Color,
+    color_print,
+    flush_logging,
+    logger,
+    process_pool,
+    setup_logging,
+)
 
 
 def print_macro_file_paths(macro_file_paths: List[str]):
     for macro_path in macro_file_paths:
-        print(f'Loading macros from {macro_path}')
+        logger.info('Loading macros from %s', macro_path)
 
 
 def print_variable_ifelse(macros: List[str]):
@@ -72,8 +93,10 @@ def print_variable_ifelse(macros: List[str]):
         conditional_variables = macro_conditionals(macro)
         for conditional_variable in conditional_variables:
             if conditional_variable.startswith('$'):
-                print(
-                    f'Macro {name} contains variable ifelse: {conditional_variable}'
+                logger.info(
+                    'Macro %s contains variable ifelse: %s',
+                    name,
+                    conditional_variable,
                 )
 
 
@@ -94,18 +117,118 @@ def sort_macros(macros: List[Tuple[str, List[Rule]]]):
         rules.sort(key=rule_arity, reverse=True)
 
 
-def decompile_cil(
+def read_cil_lines(
+    cil_path: str,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Generator[str, None, None]:
+    # Iterate the file instead of reading it whole to keep memory usage
+    # independent of the policy size
+    # start and end must point to the beginning of a line
+    with open(cil_path, 'rb') as file:
+        file.seek(start)
+        position = start
+
+        for line in file:
+            if end is not None and position >= end:
+                break
+
+            position += len(line)
+            yield line.decode().rstrip('\r\n')
+
+
+def cil_shards(cil_path: str, shards: int):
+    size = os.path.getsize(cil_path)
+
+    offsets = [0]
+    with open(cil_path, 'rb') as file:
+        for i in range(1, shards):
+            offset = max(size * i // shards, offsets[-1])
+            if offset == 0:
+                continue
+
+            # Move the offset to the beginning of the next line
+            file.seek(offset - 1)
+            file.readline()
+            offsets.append(file.tell())
+    offsets.append(size)
+
+    return [
+        (start, end) for start, end in zip(offsets, offsets[1:]) if start < end
+    ]
+
+
+def load_conditional_types(
     cil_path: str,
     conditional_types_map: Dict[str, ConditionalType],
-    missing_generated_types: Set[str],
     version: Optional[str],
 ):
-    cil_data = Path(cil_path).read_text()
-    cil_lines = cil_data.splitlines()
+    for line in read_cil_lines(cil_path):
+        name_conditional_type = CilRule.conditional_type_from_line(
+            line,
+            version,
+        )
+        if name_conditional_type is None:
+            continue
 
-    genfs_rules: List[Rule] = []
+        name, conditional_type = name_conditional_type
+        assert name not in conditional_types_map
+        conditional_types_map[name] = conditional_type
+
+
+PLATFORM_CONDITIONAL_TYPES_CACHE = 'platform_conditional_types_v1'
 
-    # Convert lines to rules
+
+def load_platform_conditional_types(
+    cil_path: str,
+    conditional_types_map: Dict[str, ConditionalType],
+    version: Optional[str],
+    cache: Optional[Cache],
+):
+    if cache is None:
+        load_conditional_types(cil_path, conditional_types_map, version)
+        return
+
+    key = text_digest(file_digest(cil_path), str(version))
+    data = cache.get(PLATFORM_CONDITIONAL_TYPES_CACHE, key)
+    if data is not None:
+        cached_conditional_types = pickle.loads(data)
+        for name, (positive, negative, is_all) in cached_conditional_types:
+            assert name not in conditional_types_map
+            conditional_types_map[name] = ConditionalType(
+                positive,
+                negative,
+                is_all,
+            )
+        return
+
+    platform_conditional_types_map: Dict[str, ConditionalType] = {}
+    load_conditional_types(cil_path, platform_conditional_types_map, version)
+
+    # Store plain values to keep the cache compact and independent of
+    # the ConditionalType implementation
+    cached_conditional_types = [
+        (name, (c.positive, c.negative, c.is_all))
+        for name, c in platform_conditional_types_map.items()
+    ]
+    data = pickle.dumps(
+        cached_conditional_types,
+        protocol=pickle.HIGHEST_PROTOCOL,
+    )
+    cache.put(PLATFORM_CONDITIONAL_TYPES_CACHE, key, data)
+
+    for name, conditional_type in platform_conditional_types_map.items():
+        assert name not in conditional_types_map
+        conditional_types_map[name] = conditional_type
+
+
+def cil_rules(
+    lines: Iterable[str],
+    conditional_types_map: Dict[str, ConditionalType],
+    missing_generated_types: Set[str],
+    genfs_rules: List[Rule],
+    version: Optional[str],
+) -> Iterable[Rule]:
     fn = partial(
         CilRule.from_line,
         conditional_types_map=conditional_types_map,
@@ -113,9 +236,93 @@ def decompile_cil(
         genfs_rules=genfs_rules,
         version=version,
     )
-    rules = list(chain.from_iterable(map(fn, cil_lines)))
+    return chain.from_iterable(map(fn, lines))
+
+
+def decompile_cil_shard(
+    cil_path: str,
+    start: int,
+    end: int,
+    conditional_types_map: Dict[str, ConditionalType],
+    version: Optional[str],
+):
+    genfs_rules: List[Rule] = []
+    missing_generated_types: Set[str] = set()
+    rules = list(
+        cil_rules(
+            read_cil_lines(cil_path, start, end),
+            conditional_types_map,
+            missing_generated_types,
+            genfs_rules,
+            version,
+        )
+    )
+
+    return rules, genfs_rules, missing_generated_types
+
+
+def decompile_cil_parallel(
+    cil_path: str,
+    conditional_types_map: Dict[str, ConditionalType],
+    missing_generated_types: Set[str],
+    genfs_rules: List[Rule],
+    version: Optional[str],
+    jobs: int,
+) -> Generator[Rule, None, None]:
+    with process_pool(jobs) as executor:
+        futures = [
+            executor.submit(
+                decompile_cil_shard,
+                cil_path,
+                start,
+                end,
+                conditional_types_map,
+                version,
+            )
+            for start, end in cil_shards(cil_path, jobs)
+        ]
+
+        # Merge the shards in order to keep the same output as when
+        # parsing serially
+        for future in futures:
+            shard_rules, shard_genfs_rules, shard_missing_generated_types = (
+                future.result()
+            )
+            genfs_rules.extend(shard_genfs_rules)
+            missing_generated_types.update(shard_missing_generated_types)
+            yield from shard_rules
+
+
+def decompile_cil(
+    cil_path: str,
+    conditional_types_map: Dict[str, ConditionalType],
+    missing_generated_types: Set[str],
+    genfs_rules: List[Rule],
+    version: Optional[str],
+    jobs: int = 1,
+) -> Iterable[Rule]:
+    # Conditional types need to be fully gathered before rules are created
+    # so that generated types can be resolved, do it in a first pass
+    load_conditional_types(cil_path, conditional_types_map, version)
+
+    if jobs > 1:
+        return decompile_cil_parallel(
+            cil_path,
+            conditional_types_map,
+            missing_generated_types,
+            genfs_rules,
+            version,
+            jobs,
+        )
 
-    return rules, genfs_rules
+    # Convert lines to rules lazily
+    return cil_rules(
+        read_cil_lines(cil_path),
+        conditional_types_map,
+        missing_generated_types,
+        genfs_rules,
+        version,
+    )
 
 
 def get_selinux_dir_policy(selinux_dir: str):
@@ -133,6 +340,366 @@ def get_selinux_dir_policy(selinux_dir: str):
     return str(platform_policy_path), str(policy_path), policy_version
 
 
+class DecompiledMacros:
+    def __init__(
+        self,
+        macros_name_rules: List[Tuple[str, List[Rule]]],
+        perms: List[Tuple[str, Set[str]]],
+        class_sets: List[Tuple[str, Set[str]]],
+        ioctls: List[Tuple[str, IoctlSet]],
+        ioctl_defines: Dict[int, str],
+    ):
+        self.macros_name_rules = macros_name_rules
+        self.perms = perms
+        self.class_sets = class_sets
+        self.ioctls = ioctls
+        self.ioctl_defines = ioctl_defines
+
+
+variables_key_type = Tuple[Tuple[str, str], ...]
+
+
+class MacroArtefacts:
+    # Macros and classmap are shared by all the policies decompiled in one
+    # run, only the variables used to expand the macros depend on the policy
+    def __init__(
+        self,
+        macro_paths: List[str],
+        classmap: Classmap,
+        cache: Optional[Cache],
+    ):
+        macro_file_paths = resolve_macro_paths(macro_paths)
+
+        print_macro_file_paths(macro_file_paths)
+
+        self.input_text, self.macros_text = read_macros(macro_file_paths)
+
+        print_variable_ifelse(self.macros_text)
+
+        self.classmap = classmap
+        self.cache = cache
+        self.__decompiled_macros: Dict[
+            variables_key_type,
+            DecompiledMacros,
+        ] = {}
+
+    def decompiled_macros_map(self):
+        return self.__decompiled_macros.copy()
+
+    def update_decompiled_macros_map(
+        self,
+        decompiled_macros_map: Dict[variables_key_type, DecompiledMacros],
+    ):
+        self.__decompiled_macros.update(decompiled_macros_map)
+
+    def decompiled_macros(
+        self,
+        variables: Dict[str, str],
+        profiler: PhaseProfiler,
+    ):
+        key = tuple(sorted(variables.items()))
+        if key in self.__decompiled_macros:
+            return self.__decompiled_macros[key]
+
+        with profiler.phase('m4_expansion'):
+            expanded_macros_text = expand_macro_bodies(
+                self.input_text,
+                self.macros_text,
+                variables,
+                self.cache,
+            )
+            macros_name_body = split_macros_text_name_body(expanded_macros_text)
+
+            expanded_macros, class_sets, perms, ioctls, ioctl_defines = (
+                categorize_macros(macros_name_body)
+            )
+            decompiled_perms = decompile_perms(perms)
+            decompiled_class_sets = decompile_perms(class_sets)
+            decompiled_ioctls = decompile_ioctls(ioctls)
+            decompiled_ioctl_defines = decompile_ioctl_defines(ioctl_defines)
+
+        with profiler.phase('macro_decompile'):
+            macros_name_rules = decompile_macros(
+                self.classmap,
+                expanded_macros,
+            )
+
+            sort_macros(macros_name_rules)
+
+        decompiled_macros = DecompiledMacros(
+            macros_name_rules,
+            decompiled_perms,
+            decompiled_class_sets,
+            decompiled_ioctls,
+            decompiled_ioctl_defines,
+        )
+        self.__decompiled_macros[key] = decompiled_macros
+
+        return decompiled_macros
+
+
+def parse_policy(
+    platform_policy: str,
+    policy: str,
+    version: Optional[str],
+    cache: Optional[Cache],
+    profiler: PhaseProfiler,
+    jobs: int = 1,
+):
+    conditional_types_map: Dict[str, ConditionalType] = {}
+    missing_generated_types: Set[str] = set()
+
+    with profiler.phase('platform_parse'):
+        # Only load generated types from platform policy
+        load_platform_conditional_types(
+            platform_policy,
+            conditional_types_map,
+            version,
+            cache,
+        )
+
+    with profiler.phase('vendor_parse_mld_build'):
+        genfs_rules: List[Rule] = []
+        rules = decompile_cil(
+            policy,
+            conditional_types_map,
+            missing_generated_types,
+            genfs_rules,
+            version,
+            jobs,
+        )
+
+        mld: MultiLevelDict[Rule] = MultiLevelDict()
+        for rule in rules:
+            # Add partial matches to this rule
+            # Start partial matching after the first key
+            mld.add(rule.hash_values, rule, RULE_DYNAMIC_PARTS_INDEX)
+
+    for t in sorted(missing_generated_types):
+        color_print(
+            f'Generated type {t} not found',
+            color=Color.YELLOW,
+            level=logging.WARNING,
+        )
+
+    return mld, genfs_rules
+
+
+def decompile_policy(
+    selinux_dir: Optional[str],
+    platform_policy: str,
+    policy: str,
+    version: Optional[str],
+    output_dir: str,
+    artefacts: MacroArtefacts,
+    variables_overrides: Dict[str, str],
+    incremental_state: Optional[str],
+    profiler: PhaseProfiler,
+    jobs: int = 1,
+):
+    mld, genfs_rules = parse_policy(
+        platform_policy,
+        policy,
+        version,
+        artefacts.cache,
+        profiler,
+        jobs,
+    )
+
+    variables = get_default_variables(mld)
+    variables.update(variables_overrides)
+
+    macros = artefacts.decompiled_macros(variables, profiler)
+
+    color_print(f'Total rules: {len(mld)}', color=Color.GREEN)
+
+    with profiler.phase('macro_matching'):
+        macro_stats_collector = MacroStatsCollector()
+        if incremental_state is None:
+            macros_rule_matches = match_all_macro_rules(
+                mld,
+                macros.macros_name_rules,
+                macro_stats_collector,
+                jobs,
+            )
+        else:
+            macros_rule_matches = match_all_macro_rules_incremental(
+                mld,
+                macros.macros_name_rules,
+                macro_stats_collector,
+                incremental_state,
+                jobs,
+            )
+
+        all_rule_matches: Set[RuleMatch] = set()
+        for rule_matches in macros_rule_matches.values():
+            all_rule_matches.update(rule_matches)
+
+    with profiler.phase('replace_merge'):
+        replace_macro_rules(mld, all_rule_matches)
+        merge_typeattribute_rules(mld)
+        merge_ioctl_rules(mld)
+
+        replace_perms(mld, artefacts.classmap, macros.perms)
+        replace_ioctls(mld, macros.ioctls, macros.ioctl_defines)
+        merge_class_sets(mld, macros.class_sets)
+
+        # We can also merge target domains, but rules get long quickly
+        # merge_target_domains(mld)
+
+    color_print(f'Leftover rules: {len(mld)}', color=Color.GREEN)
+
+    with profiler.phase('output'):
+        grouped_rules = group_rules(mld)
+
+        if incremental_state is None:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir, exist_ok=True)
+
+        output_names = output_policy(
+            selinux_dir,
+            genfs_rules,
+            grouped_rules,
+            output_dir,
+            jobs,
+        )
+
+        if incremental_state is not None:
+            remove_stale_outputs(output_dir, output_names)
+
+    # TODO: output app signing certificates
+
+    return macro_stats_collector
+
+
+# Macro artefacts shared with the batch worker processes, inherited through
+# fork to avoid serializing them for each policy
+shared_macro_artefacts: Optional[MacroArtefacts] = None
+
+
+batch_policy_result_type = Tuple[
+    MacroStatsCollector,
+    Dict[variables_key_type, DecompiledMacros],
+    Optional[Dict[str, Any]],
+]
+
+
+def decompile_batch_policy(
+    name: str,
+    selinux_dir: str,
+    output_dir: str,
+    variables_overrides: Dict[str, str],
+    incremental_state_dir: Optional[str],
+    profile: bool,
+) -> batch_policy_result_type:
+    assert shared_macro_artefacts is not None
+
+    logger.info('Decompiling %s from %s', name, selinux_dir)
+
+    known_keys = set(shared_macro_artefacts.decompiled_macros_map())
+
+    platform_policy, policy, version = get_selinux_dir_policy(selinux_dir)
+
+    incremental_state = None
+    if incremental_state_dir is not None:
+        os.makedirs(incremental_state_dir, exist_ok=True)
+        incremental_state = str(Path(incremental_state_dir, name))
+
+    profiler = PhaseProfiler(profile)
+    macro_stats_collector = decompile_policy(
+        selinux_dir,
+        platform_policy,
+        policy,
+        version,
+        str(Path(output_dir, name)),
+        shared_macro_artefacts,
+        variables_overrides,
+        incremental_state,
+        profiler,
+    )
+
+    # Return the macros decompiled for this policy to share them with the
+    # policies submitted later
+    new_decompiled_macros_map = shared_macro_artefacts.decompiled_macros_map()
+    for key in known_keys:
+        del new_decompiled_macros_map[key]
+
+    flush_logging()
+
+    report = profiler.report() if profile else None
+
+    return macro_stats_collector, new_decompiled_macros_map, report
+
+
+def decompile_batch(
+    names_selinux_dirs: List[Tuple[str, str]],
+    output_dir: str,
+    artefacts: MacroArtefacts,
+    variables_overrides: Dict[str, str],
+    incremental_state_dir: Optional[str],
+    profiler: PhaseProfiler,
+    jobs: int = 1,
+):
+    global shared_macro_artefacts
+    shared_macro_artefacts = artefacts
+
+    fn = partial(
+        decompile_batch_policy,
+        output_dir=output_dir,
+        variables_overrides=variables_overrides,
+        incremental_state_dir=incremental_state_dir,
+        profile=profiler.enabled,
+    )
+
+    results: Dict[str, batch_policy_result_type] = {}
+    try:
+        if jobs <= 1:
+            for name, selinux_dir in names_selinux_dirs:
+                results[name] = fn(name, selinux_dir)
+        else:
+            # Each policy is decompiled by its own worker, forked when the
+            # policy is submitted so that it inherits the macros decompiled
+            # by the previous ones for the same variables, and only the
+            # newly decompiled macros are sent back
+            remaining = deque(names_selinux_dirs)
+            executors: Dict[
+                Future[batch_policy_result_type],
+                Tuple[str, ProcessPoolExecutor],
+            ] = {}
+            try:
+                while remaining or executors:
+                    while remaining and len(executors) < jobs:
+                        name, selinux_dir = remaining.popleft()
+                        executor = process_pool(1)
+                        future = executor.submit(fn, name, selinux_dir)
+                        executors[future] = (name, executor)
+
+                    done, _ = wait(executors, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, executor = executors.pop(future)
+                        executor.shutdown()
+                        results[name] = future.result()
+                        artefacts.update_decompiled_macros_map(results[name][1])
+            finally:
+                for _, executor in executors.values():
+                    executor.shutdown(cancel_futures=True)
+    finally:
+        shared_macro_artefacts = None
+
+    macro_stats_collector = MacroStatsCollector()
+    for name, _ in names_selinux_dirs:
+        policy_stats_collector, _, report = results[name]
+        macro_stats_collector.extend(
+            policy_stats_collector.sorted_stats(),
+            name,
+        )
+
+        if report is not None:
+            profiler.add_policy_report(name, report)
+
+    return macro_stats_collector
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(
         prog='decompile_cil.py',
@@ -157,6 +724,16 @@ if __name__ == '__main__':
         action='store',
         help='Path to selinux directory (eg: vendor/etc/selinux)',
     )
+    parser.add_argument(
+        '-b',
+        '--batch',
+        action='append',
+        default=[],
+        metavar='NAME=DIR',
+        help='Decompile the selinux directory DIR into the NAME directory '
+        'inside the output directory, can be passed multiple times to share '
+        'the macros and classmap between policies',
+    )
     parser.add_argument(
         '-m',
         '--macros',
@@ -171,6 +748,13 @@ if __name__ == '__main__':
         required=True,
         help='Path to kernel (external/selinux/python/sepolgen/src/share/perm_map)',
     )
+    parser.add_argument(
+        '--classmap-extractor',
+        action='store',
+        choices=[e.value for e in ClassmapExtractor],
+        default=ClassmapExtractor.GCC.value,
+        help='Extract the classmap by compiling it with gcc or by parsing it',
+    )
     parser.add_argument(
         '-v',
         '--var',
@@ -185,119 +769,146 @@ if __name__ == '__main__':
         required=True,
         help='Output directory for the decompiled selinux',
     )
-
-    args = parser.parse_args()
-    assert args.macros
-
-    output_dir: str = args.output
-    kernel_dir: str = args.kernel
-    selinux_dir: Optional[str] = args.selinux
-
-    if selinux_dir is None:
-        assert args.platform_policy is not None
-        platform_policy: str = args.platform_policy
-        assert args.policy is not None
-        policy: str = args.policy
-
-        version: Optional[str] = args.policy_version
-    else:
-        platform_policy, policy, version = get_selinux_dir_policy(
-            selinux_dir
-        )
-
-    conditional_types_map: Dict[str, ConditionalType] = {}
-    missing_generated_types: Set[str] = set()
-
-    # Only load generated types from platform policy
-    _, _ = decompile_cil(
-        platform_policy,
-        conditional_types_map,
-        set(),
-        version,
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of worker processes',
     )
-
-    rules, genfs_rules = decompile_cil(
-        policy,
-        conditional_types_map,
-        missing_generated_types,
-        version,
+    parser.add_argument(
+        '--cache-dir',
+        action='store',
+        default=default_cache_dir(),
+        help='Directory used to cache results across runs',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store',
+        help='Write the time and memory used by each phase to a JSON file',
+    )
+    parser.add_argument(
+        '--macro-stats',
+        action='store',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Print the N macros that took the longest to match',
+    )
+    parser.add_argument(
+        '--macro-stats-csv',
+        action='store',
+        help='Write the matching stats of all macros to a CSV file',
+    )
+    parser.add_argument(
+        '--log-level',
+        action='store',
+        choices=list(LOG_LEVELS.keys()),
+        default='info',
+        help='Minimum level of the messages to print',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use or update the cache',
+    )
+    parser.add_argument(
+        '--incremental-state',
+        action='store',
+        help='Path to the state saved between runs, only re-match the '
+        'macros affected by the changed rules and only rewrite the changed '
+        'output files, a directory of states in batch mode',
     )
 
-    mld: MultiLevelDict[Rule] = MultiLevelDict()
-    for rule in rules:
-        # Add partial matches to this rule
-        # Start partial matching after the first key
-        mld.add(rule.hash_values, rule, RULE_DYNAMIC_PARTS_INDEX)
+    args = parser.parse_args()
+    assert args.macros
 
-    macro_file_paths = resolve_macro_paths(args.macros)
+    setup_logging(LOG_LEVELS[args.log_level])
 
-    print_macro_file_paths(macro_file_paths)
+    output_dir: str = args.output
+    jobs: int = args.jobs
 
-    input_text, macros_text = read_macros(macro_file_paths)
+    cache: Optional[Cache] = None
+    if not args.no_cache:
+        cache = Cache(args.cache_dir)
 
-    print_variable_ifelse(macros_text)
+    profiler = PhaseProfiler(args.profile is not None)
 
-    variables = get_default_variables(mld)
+    kernel_dir: str = args.kernel
 
+    variables_overrides: Dict[str, str] = {}
     for kv in args.var:
         k, v = kv.split('=')
-        variables[k] = v
-
-    expanded_macros_text = expand_macro_bodies(
-        input_text,
-        macros_text,
-        variables,
-    )
-    macros_name_body = split_macros_text_name_body(expanded_macros_text)
-
-    expanded_macros, class_sets, perms, ioctls, ioctl_defines = (
-        categorize_macros(macros_name_body)
-    )
-    decompiled_perms = decompile_perms(perms)
-    decompiled_class_sets = decompile_perms(class_sets)
-    decompiled_ioctls = decompile_ioctls(ioctls)
-    decompiled_ioctl_defines = decompile_ioctl_defines(ioctl_defines)
-
-    # classmap is needed to sort classes and perms to match the compiled
-    # output
-    selinux_include_path = Path(kernel_dir, SELINUX_INCLUDE_PATH).resolve()
-    classmap = Classmap(str(selinux_include_path))
-
-    macros_name_rules = decompile_macros(classmap, expanded_macros)
-
-    sort_macros(macros_name_rules)
-
-    color_print(f'Total rules: {len(mld)}', color=Color.GREEN)
-
-    all_rule_matches: Set[RuleMatch] = set()
-    for name, rules in macros_name_rules:
-        match_macro_rules(
-            mld,
-            name,
-            rules,
-            all_rule_matches,
+        variables_overrides[k] = v
+
+    with profiler.phase('classmap'):
+        # classmap is needed to sort classes and perms to match the compiled
+        # output
+        selinux_include_path = Path(kernel_dir, SELINUX_INCLUDE_PATH)
+        selinux_include_path = selinux_include_path.resolve()
+        classmap = Classmap(
+            str(selinux_include_path),
+            cache,
+            ClassmapExtractor(args.classmap_extractor),
         )
 
-    replace_macro_rules(mld, all_rule_matches)
-    merge_typeattribute_rules(mld)
-    merge_ioctl_rules(mld)
-
-    replace_perms(mld, classmap, decompiled_perms)
-    replace_ioctls(mld, decompiled_ioctls, decompiled_ioctl_defines)
-    merge_class_sets(mld, decompiled_class_sets)
-
-    # We can also merge target domains, but rules get long quickly
-    # merge_target_domains(mld)
-
-    color_print(f'Leftover rules: {len(mld)}', color=Color.GREEN)
-
-    grouped_rules = group_rules(mld)
+    with profiler.phase('macro_read'):
+        artefacts = MacroArtefacts(args.macros, classmap, cache)
+
+    if args.batch:
+        assert args.selinux is None
+        assert args.policy is None
+
+        names_selinux_dirs: List[Tuple[str, str]] = []
+        for name_selinux_dir in args.batch:
+            name, selinux_dir = name_selinux_dir.split('=', 1)
+            names_selinux_dirs.append((name, selinux_dir))
+
+        with profiler.phase('batch'):
+            macro_stats_collector = decompile_batch(
+                names_selinux_dirs,
+                output_dir,
+                artefacts,
+                variables_overrides,
+                args.incremental_state,
+                profiler,
+                jobs,
+            )
+    else:
+        selinux_dir: Optional[str] = args.selinux
+
+        if selinux_dir is None:
+            assert args.platform_policy is not None
+            platform_policy: str = args.platform_policy
+            assert args.policy is not None
+            policy: str = args.policy
+
+            version: Optional[str] = args.policy_version
+        else:
+            platform_policy, policy, version = get_selinux_dir_policy(
+                selinux_dir
+            )
+
+        macro_stats_collector = decompile_policy(
+            selinux_dir,
+            platform_policy,
+            policy,
+            version,
+            output_dir,
+            artefacts,
+            variables_overrides,
+            args.incremental_state,
+            profiler,
+            jobs,
+        )
 
-    shutil.rmtree(output_dir, ignore_errors=True)
-    os.makedirs(output_dir)
+    if args.macro_stats:
+        flush_logging()
+        macro_stats_collector.print_table(args.macro_stats)
 
-    output_contexts(selinux_dir, output_dir)
-    output_genfs_contexts(genfs_rules, output_dir)
-    output_grouped_rules(grouped_rules, output_dir)
+    if args.macro_stats_csv is not None:
+        macro_stats_collector.write_csv(args.macro_stats_csv)
 
-    # TODO: output app signing certificates
+    if args.profile is not None:
+        profiler.write_report(args.profile)
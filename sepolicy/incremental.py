@@ -0,0 +1,227 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from cache import text_digest, write_bytes_atomic
+from macro_stats import MacroStatsCollector
+from match import MacroRulePlan, RuleMatch, match_all_macro_rules
+from match_extract import args_type
+from mld import MultiLevelDict
+from rule import RULE_DYNAMIC_PARTS_INDEX, Rule
+from utils import logger
+
+INCREMENTAL_STATE_VERSION = 1
+
+# Arg values are either kept as is if they are names, or as the rule index
+# and part index they can be found at inside the matched rules
+saved_arg_type = Union[str, Tuple[int, int]]
+saved_match_type = Tuple[List[str], Dict[int, saved_arg_type]]
+
+
+def macros_digest(macros_name_rules: List[Tuple[str, List[Rule]]]):
+    # Decompiled macros depend on the macro files, the variables used to
+    # expand them and the classmap used to sort them, hash the result
+    values: List[str] = []
+    for name, rules in macros_name_rules:
+        values.append(name)
+        values.extend(map(str, rules))
+
+    return text_digest(*values)
+
+
+def save_rule_match(rule_match: RuleMatch) -> Optional[saved_match_type]:
+    # Rules and conditional types cache their hashes, which change between
+    # runs, save them as strings instead of pickling them
+    rules = sorted(rule_match.rules, key=str)
+    rule_strs = list(map(str, rules))
+
+    arg_values: Dict[int, saved_arg_type] = {}
+    for arg_index, arg_value in rule_match.arg_values.items():
+        if isinstance(arg_value, str):
+            arg_values[arg_index] = arg_value
+            continue
+
+        for rule_index, rule in enumerate(rules):
+            if arg_value in rule.parts:
+                part_index = rule.parts.index(arg_value)
+                arg_values[arg_index] = (rule_index, part_index)
+                break
+        else:
+            return None
+
+    return rule_strs, arg_values
+
+
+def load_rule_match(
+    macro_name: str,
+    saved_match: saved_match_type,
+    rules_by_str: Dict[str, Rule],
+) -> Optional[RuleMatch]:
+    rule_strs, saved_arg_values = saved_match
+
+    rules: List[Rule] = []
+    for rule_str in rule_strs:
+        rule = rules_by_str.get(rule_str)
+        if rule is None:
+            return None
+
+        rules.append(rule)
+
+    arg_values: args_type = {}
+    for arg_index, saved_arg_value in saved_arg_values.items():
+        if isinstance(saved_arg_value, str):
+            arg_values[arg_index] = saved_arg_value
+            continue
+
+        rule_index, part_index = saved_arg_value
+        arg_values[arg_index] = rules[rule_index].parts[part_index]
+
+    return RuleMatch(macro_name, set(rules), arg_values)
+
+
+class IncrementalState:
+    def __init__(
+        self,
+        macros_digest: str,
+        rule_strs: Set[str],
+        macros_matches: Dict[str, List[saved_match_type]],
+    ):
+        self.version = INCREMENTAL_STATE_VERSION
+        self.macros_digest = macros_digest
+        self.rule_strs = rule_strs
+        self.macros_matches = macros_matches
+
+    @classmethod
+    def load(cls, path: str) -> Optional[IncrementalState]:
+        try:
+            data = Path(path).read_bytes()
+        except OSError:
+            return None
+
+        try:
+            state = pickle.loads(data)
+        except (pickle.UnpicklingError, AttributeError, EOFError):
+            return None
+
+        if not isinstance(state, IncrementalState):
+            return None
+
+        if state.version != INCREMENTAL_STATE_VERSION:
+            return None
+
+        return state
+
+    def save(self, path: str):
+        data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        write_bytes_atomic(Path(path), data)
+
+
+def affected_macros(
+    macros_name_rules: List[Tuple[str, List[Rule]]],
+    changed_rules: List[Rule],
+):
+    changed_mld: MultiLevelDict[Rule] = MultiLevelDict()
+    for rule in changed_rules:
+        changed_mld.add(rule.hash_values, rule, RULE_DYNAMIC_PARTS_INDEX)
+
+    # Matching a macro only looks up rules that have the literal parts of
+    # its rules, if none of the changed rules has them, the macro matches
+    # the same rules it did before
+    names: Set[str] = set()
+    for name, rules in macros_name_rules:
+        for rule in rules:
+            match_keys = MacroRulePlan(rule).match_keys()
+            if next(changed_mld.match(match_keys), None) is not None:
+                names.add(name)
+                break
+
+    return names
+
+
+def match_all_macro_rules_incremental(
+    mld: MultiLevelDict[Rule],
+    macros_name_rules: List[Tuple[str, List[Rule]]],
+    stats_collector: MacroStatsCollector,
+    state_path: str,
+    jobs: int = 1,
+):
+    digest = macros_digest(macros_name_rules)
+    rules_by_str = {str(rule): rule for rule in mld.walk()}
+    rule_strs = set(rules_by_str.keys())
+
+    state = IncrementalState.load(state_path)
+    if state is not None and state.macros_digest != digest:
+        logger.info('Macros changed, matching all macros')
+        state = None
+
+    macros_rule_matches: Dict[str, Set[RuleMatch]] = {}
+    remaining_macros_name_rules = macros_name_rules
+
+    if state is not None:
+        # Added rules can only create matches for the macros that look them
+        # up, while removed rules can only drop the matches they are part of
+        added_rules = [rules_by_str[s] for s in rule_strs - state.rule_strs]
+        removed_rule_strs = state.rule_strs - rule_strs
+        names = affected_macros(macros_name_rules, added_rules)
+
+        for name, _ in macros_name_rules:
+            if name in names or name not in state.macros_matches:
+                continue
+
+            saved_matches = state.macros_matches[name]
+            rule_matches: Set[RuleMatch] = set()
+            for saved_match in saved_matches:
+                if not removed_rule_strs.isdisjoint(saved_match[0]):
+                    break
+
+                rule_match = load_rule_match(name, saved_match, rules_by_str)
+                if rule_match is None:
+                    break
+
+                rule_matches.add(rule_match)
+            else:
+                macros_rule_matches[name] = rule_matches
+
+        remaining_macros_name_rules = [
+            (name, rules)
+            for name, rules in macros_name_rules
+            if name not in macros_rule_matches
+        ]
+
+        logger.info(
+            'Rules changed: %d added, %d removed, matching %d/%d macros',
+            len(added_rules),
+            len(removed_rule_strs),
+            len(remaining_macros_name_rules),
+            len(macros_name_rules),
+        )
+
+    macros_rule_matches.update(
+        match_all_macro_rules(
+            mld,
+            remaining_macros_name_rules,
+            stats_collector,
+            jobs,
+        )
+    )
+
+    macros_matches: Dict[str, List[saved_match_type]] = {}
+    for name, rule_matches in macros_rule_matches.items():
+        saved_matches: List[saved_match_type] = []
+        for rule_match in rule_matches:
+            saved_match = save_rule_match(rule_match)
+            if saved_match is None:
+                break
+
+            saved_matches.append(saved_match)
+        else:
+            macros_matches[name] = saved_matches
+
+    IncrementalState(digest, rule_strs, macros_matches).save(state_path)
+
+    return macros_rule_matches
@@ -0,0 +1,122 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+from bisect import bisect_right
+from typing import Iterable, List, Tuple
+
+IOCTL_RANGE_SEPARATOR = '-'
+
+interval_type = Tuple[int, int]
+
+
+def parse_ioctl(value: str):
+    return int(value, base=16)
+
+
+def format_ioctl_interval(interval: interval_type):
+    start, end = interval
+    if start == end:
+        return hex(start)
+
+    return f'{hex(start)}{IOCTL_RANGE_SEPARATOR}{hex(end)}'
+
+
+class IoctlSet:
+    __slots__ = ('intervals', '__starts')
+
+    def __init__(self, intervals: Iterable[interval_type] = ()):
+        # Keep the intervals sorted, with overlapping and adjacent intervals
+        # merged, so that equal sets have equal intervals
+        merged: List[interval_type] = []
+        for start, end in sorted(intervals):
+            assert start <= end, (start, end)
+
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+                continue
+
+            merged.append((start, end))
+
+        self.intervals: Tuple[interval_type, ...] = tuple(merged)
+        self.__starts = [start for start, _ in merged]
+
+    @classmethod
+    def from_strs(cls, values: Iterable[str]):
+        # Values are either a single ioctl or an inclusive range of ioctls,
+        # eg: 0x5401 or 0x5400-0x54ff
+        intervals: List[interval_type] = []
+        for value in values:
+            start, _, end = value.partition(IOCTL_RANGE_SEPARATOR)
+            start_ioctl = parse_ioctl(start)
+            end_ioctl = parse_ioctl(end) if end else start_ioctl
+            intervals.append((start_ioctl, end_ioctl))
+
+        return cls(intervals)
+
+    def to_strs(self):
+        return tuple(map(format_ioctl_interval, self.intervals))
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self.intervals)
+
+    def __bool__(self):
+        return bool(self.intervals)
+
+    def __eq__(self, other: object):
+        if not isinstance(other, IoctlSet):
+            return False
+
+        return self.intervals == other.intervals
+
+    def __hash__(self):
+        return hash(self.intervals)
+
+    def __str__(self):
+        return ' '.join(self.to_strs())
+
+    def __contains_interval(self, interval: interval_type):
+        start, end = interval
+
+        # Intervals are disjoint, only the last one starting before this
+        # interval can contain it
+        index = bisect_right(self.__starts, start) - 1
+        if index < 0:
+            return False
+
+        return self.intervals[index][1] >= end
+
+    def __le__(self, other: IoctlSet):
+        return all(map(other.__contains_interval, self.intervals))
+
+    def __or__(self, other: IoctlSet):
+        return IoctlSet(self.intervals + other.intervals)
+
+    def __sub__(self, other: IoctlSet):
+        other_intervals = other.intervals
+        intervals: List[interval_type] = []
+
+        j = 0
+        for start, end in self.intervals:
+            # Skip the intervals that end before this interval
+            while j < len(other_intervals) and other_intervals[j][1] < start:
+                j += 1
+
+            k = j
+            while k < len(other_intervals) and other_intervals[k][0] <= end:
+                other_start, other_end = other_intervals[k]
+                if other_start > start:
+                    intervals.append((start, other_start - 1))
+
+                start = max(start, other_end + 1)
+                if other_end >= end:
+                    break
+
+                k += 1
+
+            if start <= end:
+                intervals.append((start, end))
+
+        return IoctlSet(intervals)
@@ -3,19 +3,23 @@
 
 from __future__ import annotations
 
+import logging
 import re
 import subprocess
 from functools import partial
 from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
+from cache import Cache, text_digest
 from classmap import Classmap
+from ioctl_set import IoctlSet, parse_ioctl
 from rule import Rule, flatten_parts, unpack_line
 from source_rule import SourceRule
 from utils import Color, color_print, split_normalize_text
 
 MACRO_START = 'define(`'
+EXPANDED_MACROS_CACHE = 'expanded_macros_v1'
 
 
 def split_macros(lines: List[str]):
@@ -126,6 +130,7 @@ def expand_macro_bodies(
     input_text: str,
     macros: List[str],
     variables: Dict[str, str],
+    cache: Optional[Cache] = None,
 ):
     macro_calls = list(map(macro_name_call, macros))
 
@@ -146,12 +151,24 @@ define(`quote_end', {quote_char("'")})
 
     variables_args_k_v = [('-D', f'{k}={v}') for k, v in variables.items()]
     variables_args = [x for p in variables_args_k_v for x in p]
+
+    # The input text contains all the macro files, any change to them or
+    # to the variables results in a different key
+    key = text_digest(input_text, *variables_args)
+    if cache is not None:
+        data = cache.get(EXPANDED_MACROS_CACHE, key)
+        if data is not None:
+            return data.decode()
+
     output_text = subprocess.check_output(
         ['m4', *variables_args],
         input=input_text,
         text=True,
     )
 
+    if cache is not None:
+        cache.put(EXPANDED_MACROS_CACHE, key, output_text.encode())
+
     return output_text
 
 
@@ -170,7 +187,11 @@ def categorize_macros(macros_name_body: List[Tuple[str, str]]):
 
     for name, body in macros_name_body:
         if not body:
-            color_print(f'Empty macro {name}', color=Color.YELLOW)
+            color_print(
+                f'Empty macro {name}',
+                color=Color.YELLOW,
+                level=logging.WARNING,
+            )
             continue
 
         macro_tuple = (name, body)
@@ -252,7 +273,11 @@ def decompile_macros(
         try:
             rules = list(chain.from_iterable(map(from_line_fn, lines)))
         except ValueError:
-            color_print(f'Invalid macro {name}', color=Color.YELLOW)
+            color_print(
+                f'Invalid macro {name}',
+                color=Color.YELLOW,
+                level=logging.WARNING,
+            )
             continue
 
         expanded_macro_rules.append((name, rules))
@@ -281,23 +306,8 @@ def decompile_perms(perms: List[Tuple[str, str]]):
     return decompiled_perms
 
 
-def unpack_ioctl(part: str):
-    if '-' not in part:
-        yield hex(int(part, base=16))
-        return
-
-    parts = part.split('-')
-    assert len(parts) == 2
-
-    start_ioctl = int(parts[0], base=16)
-    end_ioctl = int(parts[1], base=16)
-
-    for n in range(start_ioctl, end_ioctl + 1):
-        yield hex(n)
-
-
 def decompile_ioctls(ioctls: List[Tuple[str, str]]):
-    decompiled_ioctls: List[Tuple[str, Set[str]]] = []
+    decompiled_ioctls: List[Tuple[str, IoctlSet]] = []
 
     for name, text in ioctls:
         parts = unpack_line(
@@ -308,24 +318,23 @@ def decompile_ioctls(ioctls: List[Tuple[str, str]]):
             open_by_default=True,
             ignored_chars=';',
         )
-        flattened_parts = flatten_parts(parts)
-        unpacked_ioctls = map(unpack_ioctl, flattened_parts)
-        parts_set = set(chain.from_iterable(unpacked_ioctls))
-        decompiled_ioctls.append((name, parts_set))
+        ioctl_set = IoctlSet.from_strs(flatten_parts(parts))
+        decompiled_ioctls.append((name, ioctl_set))
 
     return decompiled_ioctls
 
 
 def decompile_ioctl_defines(ioctl_defines: List[Tuple[str, str]]):
-    decompiled_ioctl_defines: Dict[str, str] = {}
+    decompiled_ioctl_defines: Dict[int, str] = {}
 
     for name, text in ioctl_defines:
-        value = hex(int(text, base=16))
+        value = parse_ioctl(text)
         if value in decompiled_ioctl_defines:
             existing_name = decompiled_ioctl_defines[value]
             color_print(
-                f'Ioctl {name}={value} already defined as {existing_name}',
+                f'Ioctl {name}={hex(value)} already defined as {existing_name}',
                 color=Color.YELLOW,
+                level=logging.WARNING,
             )
             continue
 
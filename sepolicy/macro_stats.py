@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import csv
+from typing import Iterable, List, Optional
+
+MACRO_STATS_CSV_HEADER = [
+    'policy',
+    'macro',
+    'time',
+    'calls',
+    'mld_lookups',
+    'extract_calls',
+    'step_candidates',
+]
+
+
+class MacroStats:
+    def __init__(self, macro_name: str):
+        # Only set when decompiling multiple policies in batch mode
+        self.policy_name: Optional[str] = None
+        self.macro_name = macro_name
+        self.time = 0.0
+        self.calls = 0
+        self.mld_lookups = 0
+        self.extract_calls = 0
+        # Number of candidates left after matching each macro rule
+        self.step_candidates: List[int] = []
+
+    def csv_row(self):
+        return [
+            self.policy_name or '',
+            self.macro_name,
+            f'{self.time:.6f}',
+            self.calls,
+            self.mld_lookups,
+            self.extract_calls,
+            ' '.join(map(str, self.step_candidates)),
+        ]
+
+
+class MacroStatsCollector:
+    def __init__(self):
+        self.__stats: List[MacroStats] = []
+
+    def __len__(self):
+        return len(self.__stats)
+
+    def add(self, stats: MacroStats):
+        self.__stats.append(stats)
+
+    def extend(
+        self,
+        stats: Iterable[MacroStats],
+        policy_name: Optional[str] = None,
+    ):
+        for s in stats:
+            if policy_name is not None:
+                s.policy_name = policy_name
+
+            self.__stats.append(s)
+
+    def sorted_stats(self):
+        return sorted(self.__stats, key=lambda s: s.time, reverse=True)
+
+    def print_table(self, top: int):
+        sorted_stats = self.sorted_stats()[:top]
+
+        name_width = max((len(s.macro_name) for s in sorted_stats), default=0)
+        name_width = max(name_width, len('macro'))
+
+        # Only show the policy column in batch mode
+        policy_names = [s.policy_name or '' for s in sorted_stats]
+        policy_width = max(map(len, policy_names), default=0)
+        if policy_width:
+            policy_width = max(policy_width, len('policy'))
+            policy_header = f'{"policy":<{policy_width}} '
+        else:
+            policy_header = ''
+
+        print(
+            f'{policy_header}{"macro":<{name_width}} {"time":>10} '
+            f'{"calls":>8} {"lookups":>10} {"extracts":>10} candidates'
+        )
+        for policy_name, s in zip(policy_names, sorted_stats):
+            policy_column = ''
+            if policy_width:
+                policy_column = f'{policy_name:<{policy_width}} '
+
+            step_candidates = ' '.join(map(str, s.step_candidates))
+            print(
+                f'{policy_column}{s.macro_name:<{name_width}} '
+                f'{s.time:>10.4f} {s.calls:>8} {s.mld_lookups:>10} '
+                f'{s.extract_calls:>10} {step_candidates}'
+            )
+
+    def write_csv(self, path: str):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(MACRO_STATS_CSV_HEADER)
+            for s in self.sorted_stats():
+                writer.writerow(s.csv_row())
@@ -3,19 +3,24 @@
 
 from __future__ import annotations
 
-from typing import Dict, List, Optional, Set, Tuple
+import logging
+import time
+from bisect import bisect_left
+from typing import AbstractSet, Dict, FrozenSet, List, Optional, Set, Tuple
 
 from class_set import ClassSet
 from classmap import Classmap
 from conditional_type import ConditionalType
+from ioctl_set import IoctlSet, format_ioctl_interval
+from macro_stats import MacroStats, MacroStatsCollector
 from match_extract import (
     args_type,
     merge_arg_values,
+    part_extract_single_match_arg_index,
     rule_extract_part,
-    rule_extract_part_iter,
 )
-from match_replace import rule_replace_part_iter
-from mld import MultiLevelDict
+from match_replace import rule_replace_part
+from mld import MultiLevelDict, mask_type
 from rule import (
     ALLOW_RULE_TYPES,
     CLASS_SETS_RULE_TYPES,
@@ -26,10 +31,22 @@ from rule import (
     rule_part,
     rule_part_or_varargs,
 )
-from utils import Color, color_print
+from utils import Color, color_print, flush_logging, logger, process_pool
+
+# Part index, arg index for single arg parts, filled part for the others
+unfilled_parts_type = List[Tuple[int, Optional[int], Optional[rule_part]]]
 
 
 class RuleMatch:
+    __slots__ = (
+        'macro_name',
+        'rules',
+        'arg_values',
+        'hash_values',
+        'hash',
+        'macro',
+    )
+
     def __init__(
         self,
         macro_name: str,
@@ -75,83 +92,150 @@ class RuleMatch:
         return str(self.macro)
 
 
-def rule_match_keys(rule: Rule, is_match_keys_full: bool):
-    match_keys: List[Optional[rule_part_or_varargs]] = [rule.rule_type]
+class MacroRulePlan:
+    def __init__(self, macro_rule: Rule):
+        self.rule = macro_rule
 
-    for part in rule.parts:
-        # A fully filled rule doesn't need to have its parts tested
-        # to check if they need to be filled
-        if is_match_keys_full:
-            match_keys.append(part)
-            continue
+        # Work out once which parts of the macro rule are literal, which
+        # parts are a single arg that can be used as is, and which parts
+        # need to be filled and extracted using their args
+        self.__match_keys: List[Optional[rule_part_or_varargs]] = [
+            macro_rule.rule_type
+        ]
+        self.__single_arg_parts: List[Tuple[int, int]] = []
+        self.__complex_parts: List[Tuple[int, rule_part, Set[int]]] = []
 
-        # Match part to itself to see if it has any args
-        part_args_values = rule_extract_part(part, part)
+        args: Set[int] = set()
+        for index, part in enumerate(macro_rule.parts):
+            # Match part to itself to see if it has any args
+            part_args = rule_extract_part(part, part)
+            assert part_args is not None
 
-        if part_args_values:
-            match_keys.append(None)
-        else:
-            match_keys.append(part)
+            if not part_args:
+                self.__match_keys.append(part)
+                continue
+
+            self.__match_keys.append(None)
+            args.update(part_args.keys())
+
+            arg_index = None
+            if isinstance(part, str):
+                arg_index = part_extract_single_match_arg_index(part)
+
+            if arg_index is not None:
+                self.__single_arg_parts.append((index, arg_index))
+            else:
+                self.__complex_parts.append((index, part, set(part_args)))
+
+        self.__match_keys.append(macro_rule.varargs)
+
+        self.args = frozenset(args)
 
-    match_keys.append(rule.varargs)
+    def match_keys(self):
+        # Every rule matched by this macro rule has these keys, no matter
+        # which args are filled
+        return self.__match_keys.copy()
 
-    return match_keys
+    def fill_mask(self, filled_args: AbstractSet[int]) -> mask_type:
+        # Positions of the match keys that fill() sets when the given args
+        # are known
+        mask = [k is not None for k in self.__match_keys]
 
+        for index, arg_index in self.__single_arg_parts:
+            if arg_index in filled_args:
+                mask[index + 1] = True
+
+        for index, _, part_args in self.__complex_parts:
+            if part_args <= filled_args:
+                mask[index + 1] = True
+
+        return tuple(mask)
+
+    def fill(self, arg_values: args_type):
+        match_keys = self.__match_keys.copy()
+        unfilled_parts: unfilled_parts_type = []
+
+        for index, arg_index in self.__single_arg_parts:
+            if arg_index in arg_values:
+                match_keys[index + 1] = arg_values[arg_index]
+            else:
+                unfilled_parts.append((index, arg_index, None))
+
+        for index, part, part_args in self.__complex_parts:
+            filled_part = rule_replace_part(part, arg_values)
+            if filled_part is None:
+                return None
+
+            if part_args <= arg_values.keys():
+                match_keys[index + 1] = filled_part
+            else:
+                unfilled_parts.append((index, None, filled_part))
+
+        return match_keys, unfilled_parts
+
+    def extract(
+        self,
+        unfilled_parts: unfilled_parts_type,
+        matched_rule: Rule,
+    ):
+        # Filled parts are already known to be equal to the matched rule
+        # parts, only extract args from the unfilled ones
+        arg_values: Optional[args_type] = {}
+        for index, arg_index, filled_part in unfilled_parts:
+            rp = matched_rule.parts[index]
+
+            if arg_index is not None:
+                part_arg_values: Optional[args_type] = {arg_index: rp}
+            else:
+                assert filled_part is not None
+                part_arg_values = rule_extract_part(filled_part, rp)
 
-def rule_fill(rule: Rule, arg_values: args_type):
-    new_parts = rule_replace_part_iter(rule.parts, arg_values)
-    if new_parts is None:
-        return None
+            arg_values = merge_arg_values(arg_values, part_arg_values)
+            if arg_values is None:
+                return None
 
-    return Rule(rule.rule_type, tuple(new_parts), rule.varargs)
+        return arg_values
 
 
 def match_macro_rule(
     mld: MultiLevelDict[Rule],
-    macro_rule: Rule,
+    plan: MacroRulePlan,
     rule_matches: Set[RuleMatch],
+    stats: MacroStats,
 ):
-    print(f'Processing rule: {macro_rule}')
-
-    macro_rule_args = rule_extract_part_iter(
-        macro_rule.parts,
-        macro_rule.parts,
-    )
-    assert macro_rule_args is not None
+    logger.debug('Processing rule: %s', plan.rule)
 
     # Check if this rule requires only already completed args
     rule_match = next(iter(rule_matches))
-    is_match_keys_full = macro_rule_args.keys() <= rule_match.filled_args()
+    is_match_keys_full = plan.args <= rule_match.filled_args()
 
     new_rule_matches: Set[RuleMatch] = set()
     for rule_match in rule_matches:
         # print(f'Initial args: {rule_match.arg_values}')
 
-        # TODO: make rule args extraction build a path that can be used for
-        # filling no matter the args
-        filled_rule = rule_fill(macro_rule, rule_match.arg_values)
-        if filled_rule is None:
+        filled_plan = plan.fill(rule_match.arg_values)
+        if filled_plan is None:
             continue
 
-        # print(f'Filled rule: {filled_rule}')
-
-        match_keys = rule_match_keys(filled_rule, is_match_keys_full)
+        match_keys, unfilled_parts = filled_plan
         # print(f'Match keys: {match_keys}')
 
-        for matched_rule in mld.match(match_keys):
-            # print(f'Matched rule: {matched_rule}')
+        stats.mld_lookups += 1
 
-            # If the rule is fully filled don't expand the matches
-            if is_match_keys_full:
+        # If the rule is fully filled don't expand the matches, only check
+        # that the rule exists
+        if is_match_keys_full:
+            matched_rule = mld.get(match_keys)
+            if matched_rule is not None:
                 rule_match.add_rule(matched_rule)
                 new_rule_matches.add(rule_match)
-                # print()
-                break
+            continue
 
-            new_args_values = rule_extract_part_iter(
-                filled_rule.parts,
-                matched_rule.parts,
-            )
+        for matched_rule in mld.match(match_keys):
+            # print(f'Matched rule: {matched_rule}')
+
+            stats.extract_calls += 1
+            new_args_values = plan.extract(unfilled_parts, matched_rule)
             if new_args_values is None:
                 continue
 
@@ -171,26 +255,102 @@ def match_macro_rules(
     macro_rules: List[Rule],
     all_rule_matches: Set[RuleMatch],
 ):
-    print(f'Processing macro: {macro_name}')
+    logger.debug('Processing macro: %s', macro_name)
+
+    stats = MacroStats(macro_name)
+    start = time.perf_counter()
+
+    plans = [MacroRulePlan(macro_rule) for macro_rule in macro_rules]
 
     rule_matches: Set[RuleMatch] = set([RuleMatch(macro_name)])
-    for macro_rule in macro_rules:
+    for plan in plans:
         new_rule_matches = match_macro_rule(
             mld,
-            macro_rule,
+            plan,
             rule_matches,
+            stats,
         )
-        print(f'Found {len(new_rule_matches)} candidates')
+        stats.step_candidates.append(len(new_rule_matches))
+        logger.debug('Found %d candidates', len(new_rule_matches))
         if not len(new_rule_matches):
-            print()
-            return
+            break
 
         rule_matches = new_rule_matches
+    else:
+        all_rule_matches.update(rule_matches)
+        stats.calls = len(rule_matches)
+
+    stats.time = time.perf_counter() - start
+
+    return stats
+
+
+# MultiLevelDict shared with the worker processes, inherited through fork
+# to avoid serializing it for each macro
+shared_mld: Optional[MultiLevelDict[Rule]] = None
+
+
+def match_macro_rules_worker(macro_name_rules: Tuple[str, List[Rule]]):
+    assert shared_mld is not None
+
+    macro_name, macro_rules = macro_name_rules
+    rule_matches: Set[RuleMatch] = set()
+    stats = match_macro_rules(
+        shared_mld,
+        macro_name,
+        macro_rules,
+        rule_matches,
+    )
 
-    all_rule_matches.update(rule_matches)
+    flush_logging()
 
-    print(f'Found {len(rule_matches)} macro calls')
-    print()
+    return rule_matches, stats
+
+
+def match_all_macro_rules(
+    mld: MultiLevelDict[Rule],
+    macros_name_rules: List[Tuple[str, List[Rule]]],
+    stats_collector: MacroStatsCollector,
+    jobs: int = 1,
+):
+    macros_rule_matches: Dict[str, Set[RuleMatch]] = {}
+
+    if jobs <= 1:
+        for name, rules in macros_name_rules:
+            rule_matches = macros_rule_matches.setdefault(name, set())
+            stats = match_macro_rules(mld, name, rules, rule_matches)
+            stats_collector.add(stats)
+
+        return macros_rule_matches
+
+    # The args known when matching a macro rule are the ones of the macro
+    # rules before it, build the wildcard buckets that will be matched
+    # before forking, otherwise every worker builds its own copy of them
+    for _, rules in macros_name_rules:
+        filled_args: Set[int] = set()
+        for rule in rules:
+            plan = MacroRulePlan(rule)
+            mld.prepare(plan.fill_mask(filled_args))
+            filled_args.update(plan.args)
+
+    global shared_mld
+    shared_mld = mld
+
+    # The MultiLevelDict is only read while matching, fork lets the
+    # workers share it copy-on-write
+    try:
+        with process_pool(jobs) as executor:
+            for rule_matches, stats in executor.map(
+                match_macro_rules_worker,
+                macros_name_rules,
+            ):
+                name = stats.macro_name
+                macros_rule_matches.setdefault(name, set()).update(rule_matches)
+                stats_collector.add(stats)
+    finally:
+        shared_mld = None
+
+    return macros_rule_matches
 
 
 def replace_macro_rules(
@@ -202,33 +362,47 @@ def replace_macro_rules(
         color=Color.GREEN,
     )
 
-    rule_matches_map: Dict[Rule, Set[RuleMatch]] = {}
+    # Give each rule a dense index so that the subset checks below are
+    # done on sets of ints instead of calling Rule.__hash__ and __eq__
+    rule_indices: Dict[Rule, int] = {}
+    rule_matches_map: List[List[RuleMatch]] = []
+    rule_match_indices: Dict[RuleMatch, FrozenSet[int]] = {}
     for rule_match in all_rule_matches:
+        indices: List[int] = []
         for rule in rule_match.rules:
-            if rule not in rule_matches_map:
-                rule_matches_map[rule] = set()
-            rule_matches_map[rule].add(rule_match)
+            index = rule_indices.get(rule)
+            if index is None:
+                index = len(rule_indices)
+                rule_indices[rule] = index
+                rule_matches_map.append([])
 
-    discarded_rule_matches: Set[RuleMatch] = set()
+            rule_matches_map[index].append(rule_match)
+            indices.append(index)
 
-    for rule_match in all_rule_matches:
-        candidate_supersets: Optional[Set[RuleMatch]] = None
+        rule_match_indices[rule_match] = frozenset(indices)
 
-        for rule in rule_match.rules:
-            rule_matches = rule_matches_map[rule]
+    discarded_rule_matches: Set[RuleMatch] = set()
 
-            if candidate_supersets is None:
-                candidate_supersets = rule_matches
-            else:
-                candidate_supersets = candidate_supersets & rule_matches
+    for rule_match, indices in rule_match_indices.items():
+        assert indices
+
+        # A superset contains all the rules of this macro match, it is
+        # enough to look at the macro matches of its least matched rule
+        least_matched_index = min(
+            indices,
+            key=lambda index: len(rule_matches_map[index]),
+        )
 
-        assert candidate_supersets is not None
+        for candidate in rule_matches_map[least_matched_index]:
+            if candidate is rule_match:
+                continue
 
-        candidate_supersets.remove(rule_match)
+            candidate_indices = rule_match_indices[candidate]
+            if len(candidate_indices) < len(indices):
+                continue
 
-        for candidate in candidate_supersets:
-            if rule_match.rules < candidate.rules or (
-                rule_match.rules == candidate.rules
+            if indices < candidate_indices or (
+                indices == candidate_indices
                 and len(rule_match.arg_values) > len(candidate.arg_values)
             ):
                 discarded_rule_matches.add(rule_match)
@@ -256,6 +430,7 @@ def replace_macro_rules(
                 color_print(
                     f'Rule already removed: {rule}',
                     color=Color.YELLOW,
+                    level=logging.WARNING,
                 )
                 double_removed_rules.add(rule)
 
@@ -321,17 +496,17 @@ def merge_ioctl_rules(mld: MultiLevelDict[Rule]):
         if len(rules) == 1:
             continue
 
-        merged_varargs: Set[str] = set()
+        merged_ioctl_set = IoctlSet()
         for rule in rules:
             mld.remove(rule.hash_values, rule, RULE_DYNAMIC_PARTS_INDEX)
-            merged_varargs.update(rule.varargs)
+            merged_ioctl_set |= IoctlSet.from_strs(rule.varargs)
             removed_rules += 1
 
         matched_rule = next(iter(rules))
         new_rule = Rule(
             matched_rule.rule_type,
             matched_rule.parts,
-            tuple(merged_varargs),
+            merged_ioctl_set.to_strs(),
         )
         mld.add(new_rule.hash_values, new_rule, RULE_DYNAMIC_PARTS_INDEX)
         added_rules += 1
@@ -342,24 +517,49 @@ def merge_ioctl_rules(mld: MultiLevelDict[Rule]):
     )
 
 
-def replace_perms_set(
+# Perm macro name, mask of its perms that are part of the class and the
+# perms that are not
+compiled_perms_type = List[Tuple[str, int, Set[str]]]
+
+
+def compile_perms(
+    classmap: Classmap,
+    class_name: str,
     perms: List[Tuple[str, Set[str]]],
-    class_all_perms: Set[str],
-    rule_varargs_set: Set[str],
-):
-    if class_all_perms == rule_varargs_set:
-        return set(['*'])
-
-    varargs_set = rule_varargs_set
-    for name, caps in perms:
-        if caps <= varargs_set:
-            varargs_set = varargs_set - caps
-            varargs_set.add(name)
-            # TODO: find out if there are cases of multiple
-            # perms
-            break
+) -> compiled_perms_type:
+    return [
+        (name, *classmap.perms_mask(class_name, caps)) for name, caps in perms
+    ]
 
-    return varargs_set
+
+def replace_perms_set(
+    classmap: Classmap,
+    class_name: str,
+    perms: compiled_perms_type,
+    rule_varargs: Tuple[str, ...],
+) -> Optional[Tuple[str, ...]]:
+    mask, extra_perms = classmap.perms_mask(class_name, rule_varargs)
+
+    if mask == classmap.all_perms_mask(class_name) and not extra_perms:
+        return ('*',)
+
+    for name, caps_mask, caps_extra_perms in perms:
+        if caps_mask & mask != caps_mask:
+            continue
+
+        if not caps_extra_perms <= extra_perms:
+            continue
+
+        # Keep the leftover perms in classmap order so that the output
+        # does not depend on set iteration order
+        leftover_perms = classmap.mask_perms(class_name, mask & ~caps_mask)
+        leftover_extra_perms = sorted(extra_perms - caps_extra_perms)
+
+        # TODO: find out if there are cases of multiple
+        # perms
+        return (name, *leftover_perms, *leftover_extra_perms)
+
+    return None
 
 
 def replace_type_perm(
@@ -370,26 +570,38 @@ def replace_type_perm(
     removed_rules: Set[Rule],
     added_rules: Set[Rule],
 ):
-    for rule_type in ALLOW_RULE_TYPES:
-        for c in classes:
+    for c in classes:
+        class_perms = compile_perms(classmap, c, perms)
+
+        # Most rules of a class share the same few sets of perms
+        replaced_varargs: Dict[
+            Tuple[str, ...],
+            Optional[Tuple[str, ...]],
+        ] = {}
+
+        for rule_type in ALLOW_RULE_TYPES:
             match_tuple = (rule_type.value, None, None, c, None)
-            class_all_perms = set(classmap.class_perms(c))
 
             for matched_rule in mld.match(match_tuple):
-                rule_varargs_set = set(matched_rule.varargs)
-                varargs_set = replace_perms_set(
-                    perms,
-                    class_all_perms,
-                    rule_varargs_set,
-                )
-
-                if varargs_set == rule_varargs_set:
+                rule_varargs = matched_rule.varargs
+                if rule_varargs in replaced_varargs:
+                    varargs = replaced_varargs[rule_varargs]
+                else:
+                    varargs = replace_perms_set(
+                        classmap,
+                        c,
+                        class_perms,
+                        rule_varargs,
+                    )
+                    replaced_varargs[rule_varargs] = varargs
+
+                if varargs is None:
                     continue
 
                 new_rule = Rule(
                     matched_rule.rule_type,
                     matched_rule.parts,
-                    tuple(varargs_set),
+                    varargs,
                 )
                 added_rules.add(new_rule)
                 removed_rules.add(matched_rule)
@@ -455,43 +667,67 @@ def replace_perms(
     )
 
 
+def replace_ioctl_set(
+    ioctls: List[Tuple[str, IoctlSet]],
+    ioctl_defines: Dict[int, str],
+    defined_ioctls: List[int],
+    ioctl_set: IoctlSet,
+):
+    names: List[str] = []
+    for name, values in ioctls:
+        if values <= ioctl_set:
+            ioctl_set = ioctl_set - values
+            names.append(name)
+
+    # Adjacent ioctls are merged into a single interval, write the defined
+    # ioctls inside each interval by name and only the runs of undefined
+    # ioctls between them as values
+    values: List[str] = []
+    for start, end in ioctl_set.intervals:
+        index = bisect_left(defined_ioctls, start)
+        while index < len(defined_ioctls) and defined_ioctls[index] <= end:
+            ioctl = defined_ioctls[index]
+            if ioctl > start:
+                values.append(format_ioctl_interval((start, ioctl - 1)))
+
+            values.append(ioctl_defines[ioctl])
+            start = ioctl + 1
+            index += 1
+
+        if start <= end:
+            values.append(format_ioctl_interval((start, end)))
+
+    return tuple(names + values)
+
+
 def replace_ioctls(
     mld: MultiLevelDict[Rule],
-    ioctls: List[Tuple[str, Set[str]]],
-    ioctl_defines: Dict[str, str],
+    ioctls: List[Tuple[str, IoctlSet]],
+    ioctl_defines: Dict[int, str],
 ):
     removed_rules: Set[Rule] = set()
     added_rules: Set[Rule] = set()
 
+    defined_ioctls = sorted(ioctl_defines.keys())
+
     for rule_type in IOCTL_RULE_TYPES:
         match_tuple = (rule_type.value, None, None, None, None)
         for matched_rule in mld.match(match_tuple):
-            rule_varargs_set = set(matched_rule.varargs)
-
-            varargs_set = rule_varargs_set
-            for name, values in ioctls:
-                if values <= varargs_set:
-                    varargs_set = varargs_set - values
-                    varargs_set.add(name)
-
-            added_ioctls: Set[str] = set()
-            removed_ioctls: Set[str] = set()
-            for value in varargs_set:
-                if value in ioctl_defines:
-                    removed_ioctls.add(value)
-                    added_ioctls.add(ioctl_defines[value])
-
-            if added_ioctls or removed_ioctls:
-                varargs_set = varargs_set - removed_ioctls
-                varargs_set = varargs_set | added_ioctls
-
-            if varargs_set == rule_varargs_set:
+            ioctl_set = IoctlSet.from_strs(matched_rule.varargs)
+            varargs = replace_ioctl_set(
+                ioctls,
+                ioctl_defines,
+                defined_ioctls,
+                ioctl_set,
+            )
+
+            if varargs == matched_rule.varargs:
                 continue
 
             new_rule = Rule(
                 matched_rule.rule_type,
                 matched_rule.parts,
-                tuple(varargs_set),
+                varargs,
             )
             added_rules.add(new_rule)
             removed_rules.add(matched_rule)
@@ -136,7 +136,7 @@ def rule_extract_part_str(mrp: str, rp: rule_part) -> Optional[args_type]:
     return arg_values
 
 
-def rule_extract_part_set_str(mrp: List[str], rp: List[str]):
+def rule_extract_part_set_str(mrp: Tuple[str, ...], rp: Tuple[str, ...]):
     if len(mrp) != len(rp):
         return None
 
@@ -3,7 +3,7 @@
 
 from __future__ import annotations
 
-from typing import Iterable, List
+from typing import Iterable, List, Tuple
 
 from conditional_type import ConditionalType
 from match_extract import (
@@ -44,7 +44,10 @@ def rule_replace_part_str(mrp: str, arg_values: args_type):
     return rule_replace_simple_str(mrp, arg_values)
 
 
-def rule_replace_part_set_str(mrp: List[str], arg_values: args_type):
+def rule_replace_part_set_str(
+    mrp: Tuple[str, ...],
+    arg_values: args_type,
+):
     # Sets inside ConditionalType can only contain strings, and should
     # not match complex value
     new_parts: List[str] = []
@@ -3,39 +3,46 @@
 
 from __future__ import annotations
 
-import itertools
 from collections.abc import Hashable
 from typing import (
     Dict,
     Generator,
     Generic,
-    List,
+    Optional,
     Sequence,
     Set,
     Tuple,
     TypeVar,
-    Union,
 )
 
 T = TypeVar('T')
 
+keys_type = Tuple[Optional[Hashable], ...]
+mask_type = Tuple[bool, ...]
+
+
+def keys_mask(keys: keys_type) -> mask_type:
+    return tuple(k is not None for k in keys)
 
-def tuples_with_nones(
-    t: Sequence[Hashable],
-    nones_start: int,
-) -> Generator[Tuple[Union[Hashable, None], ...], None, None]:
-    choices: List[Tuple[Union[Hashable, None], ...]] = []
-    for i, x in enumerate(t):
-        if i < nones_start:
-            choices.append((x,))
-        else:
-            choices.append((x, None))
-    yield from itertools.product(*choices)
+
+def masked_keys(keys: keys_type, mask: mask_type) -> keys_type:
+    return tuple(k if m else None for k, m in zip(keys, mask))
 
 
 class MultiLevelDict(Generic[T]):
     def __init__(self):
-        self.__data: Dict[int, Dict[Tuple[Hashable, ...], Set[T]]] = {}
+        # Values indexed by their full keys, grouped by number of levels
+        self.__data: Dict[int, Dict[keys_type, Set[T]]] = {}
+        # Values indexed by their keys with some of the levels replaced by
+        # None, grouped by number of levels and by the positions of the
+        # replaced levels
+        # Buckets are only built for the positions that are matched,
+        # instead of for every possible combination
+        self.__wildcard_data: Dict[
+            int,
+            Dict[mask_type, Dict[keys_type, Set[T]]],
+        ] = {}
+        self.__nones_start: Dict[int, int] = {}
         self.__all_data: Set[T] = set()
 
     def __len__(self):
@@ -47,6 +54,36 @@ class MultiLevelDict(Generic[T]):
     def walk(self) -> Generator[T, None, None]:
         yield from self.__all_data
 
+    def __wildcard_levels_data(self, levels: int, mask: mask_type):
+        wildcard_data = self.__wildcard_data[levels]
+        if mask in wildcard_data:
+            return wildcard_data[mask]
+
+        levels_data: Dict[keys_type, Set[T]] = {}
+        for keys, values in self.__data[levels].items():
+            t = masked_keys(keys, mask)
+            if t not in levels_data:
+                levels_data[t] = set()
+
+            levels_data[t].update(values)
+
+        wildcard_data[mask] = levels_data
+
+        return levels_data
+
+    def prepare(self, mask: mask_type):
+        # Build the buckets for the given positions ahead of matching, so
+        # that processes forked afterwards share them instead of each
+        # building their own
+        levels = len(mask)
+        if levels not in self.__data or all(mask):
+            return
+
+        if not all(mask[: self.__nones_start[levels]]):
+            return
+
+        self.__wildcard_levels_data(levels, mask)
+
     def add(
         self,
         keys: Sequence[Hashable],
@@ -55,17 +92,25 @@ class MultiLevelDict(Generic[T]):
     ):
         self.__all_data.add(value)
 
-        levels = len(keys)
+        keys_tuple = tuple(keys)
+        levels = len(keys_tuple)
         if levels not in self.__data:
             self.__data[levels] = {}
+            self.__wildcard_data[levels] = {}
+            self.__nones_start[levels] = nones_start
 
         levels_data = self.__data[levels]
+        if keys_tuple not in levels_data:
+            levels_data[keys_tuple] = set()
 
-        for t in tuples_with_nones(keys, nones_start):
-            if t not in levels_data:
-                levels_data[t] = set()
+        levels_data[keys_tuple].add(value)
+
+        for mask, wildcard_levels_data in self.__wildcard_data[levels].items():
+            t = masked_keys(keys_tuple, mask)
+            if t not in wildcard_levels_data:
+                wildcard_levels_data[t] = set()
 
-            levels_data[t].add(value)
+            wildcard_levels_data[t].add(value)
 
     def remove(
         self,
@@ -75,25 +120,54 @@ class MultiLevelDict(Generic[T]):
     ):
         self.__all_data.remove(value)
 
-        levels = len(keys)
+        keys_tuple = tuple(keys)
+        levels = len(keys_tuple)
         assert levels in self.__data
         levels_data = self.__data[levels]
 
-        for t in tuples_with_nones(keys, nones_start):
-            levels_data[t].remove(value)
+        levels_data[keys_tuple].remove(value)
+        if not levels_data[keys_tuple]:
+            del levels_data[keys_tuple]
+
+        for mask, wildcard_levels_data in self.__wildcard_data[levels].items():
+            t = masked_keys(keys_tuple, mask)
+            wildcard_levels_data[t].remove(value)
+            if not wildcard_levels_data[t]:
+                del wildcard_levels_data[t]
+
+    def __values(self, keys_tuple: keys_type) -> Optional[Set[T]]:
+        levels = len(keys_tuple)
+        if levels not in self.__data:
+            return None
+
+        mask = keys_mask(keys_tuple)
+        if all(mask):
+            levels_data = self.__data[levels]
+        else:
+            # Levels before nones_start can not be matched by None
+            if not all(mask[: self.__nones_start[levels]]):
+                return None
+
+            levels_data = self.__wildcard_levels_data(levels, mask)
+
+        return levels_data.get(keys_tuple)
 
     def match(
         self,
         keys: Sequence[Hashable],
     ) -> Generator[T]:
-        keys_tuple = tuple(keys)
-
-        levels = len(keys_tuple)
-        if levels not in self.__data:
+        values = self.__values(tuple(keys))
+        if values is None:
             return
 
-        levels_data = self.__data[levels]
-        if keys_tuple not in levels_data:
-            return
+        yield from values
+
+    def get(self, keys: Sequence[Hashable]) -> Optional[T]:
+        # Return any value matching the keys, or None if there is none,
+        # without creating a generator, for callers that only need to know
+        # whether the keys are matched
+        values = self.__values(tuple(keys))
+        if not values:
+            return None
 
-        yield from levels_data[keys_tuple]
+        return next(iter(values))
@@ -4,12 +4,15 @@
 from __future__ import annotations
 
 import re
+import shutil
+from concurrent.futures import Future
 from functools import cache
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from typing import Dict, List, Optional, Set, Tuple
 
 from mld import MultiLevelDict
-from rule import Rule, RuleType
+from rule import Rule, RuleType, is_type_generated, rule_part
+from utils import process_pool
 
 VENDOR_PREFIX = 'vendor_'
 PROPERTY_CONTEXTS_NAME = 'property_contexts'
@@ -22,6 +25,29 @@ MAC_PERMISSIONS_NAME = 'mac_permissions.xml'
 KEYS_NAME = 'keys.conf'
 
 
+def write_text_if_changed(output_path: Path, text: str):
+    # Keep files that did not change untouched so that their modification
+    # time is preserved between runs
+    try:
+        if output_path.read_text() == text:
+            return
+    except OSError:
+        pass
+
+    output_path.write_text(text)
+
+
+def remove_stale_outputs(output_dir: str, names: Set[str]):
+    for path in Path(output_dir).iterdir():
+        if path.name in names:
+            continue
+
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
 def copy_contexts(input_path: str, output_path: str):
     # TODO: align parts against eachother?
 
@@ -41,15 +67,15 @@ def copy_contexts(input_path: str, output_path: str):
 
     lines.sort()
 
-    with open(output_path, 'w') as file:
-        for line in lines:
-            file.write(line)
-            file.write('\n')
+    text = ''.join(f'{line}\n' for line in lines)
+    write_text_if_changed(Path(output_path), text)
 
 
-def output_contexts(selinux_dir: Optional[str], output_dir: str):
+def find_contexts(selinux_dir: Optional[str]):
+    names_input_paths: List[Tuple[str, str]] = []
+
     if selinux_dir is None:
-        return
+        return names_input_paths
 
     for name in [
         PROPERTY_CONTEXTS_NAME,
@@ -65,16 +91,28 @@ def output_contexts(selinux_dir: Optional[str], output_dir: str):
         if not input_path.exists():
             continue
 
+        names_input_paths.append((name, str(input_path)))
+
+    return names_input_paths
+
+
+def output_contexts(selinux_dir: Optional[str], output_dir: str):
+    names: Set[str] = set()
+
+    for name, input_path in find_contexts(selinux_dir):
         output_path = Path(output_dir, name)
-        copy_contexts(str(input_path), str(output_path))
+        copy_contexts(input_path, str(output_path))
+        names.add(name)
+
+    return names
 
 
 def output_genfs_contexts(genfs_rules: List[Rule], output_dir: str):
     output_path = Path(output_dir, GENFS_CONTEXTS_NAME)
-    with open(output_path, 'w') as o:
-        for rule in genfs_rules:
-            o.write(str(rule))
-            o.write('\n')
+    text = ''.join(f'{rule}\n' for rule in genfs_rules)
+    write_text_if_changed(output_path, text)
+
+    return set([GENFS_CONTEXTS_NAME])
 
 
 @cache
@@ -98,15 +136,31 @@ PROPERTY_RULES_NAME = 'property.te'
 LEFTOVER_RULES_NAME = 'leftover.te'
 ATTRIBUTE_RULES_NAME = 'attribute'
 
+ATTRIBUTE_RULE_TYPES = set(
+    [
+        RuleType.ATTRIBUTE.value,
+        RuleType.EXPANDATTRIBUTE.value,
+        'hal_attribute',
+    ]
+)
+
+
+def is_domain_part(part: rule_part):
+    # Generated types that could not be resolved are kept as names, they
+    # are not domains either
+    return isinstance(part, str) and not is_type_generated(part)
+
 
 def domain_type(rule: Rule):
     domain = rule.parts[0]
-    if not isinstance(domain, str) and len(rule.parts) >= 2:
+    if not is_domain_part(domain) and len(rule.parts) >= 2:
         domain = rule.parts[1]
 
-    if not isinstance(domain, str):
+    if not is_domain_part(domain):
         return LEFTOVER_RULES_NAME
 
+    assert isinstance(domain, str)
+
     t = extract_domain_type(domain)
     return f'{t}.te'
 
@@ -126,13 +180,7 @@ def rule_simple_type_name(rule: Rule):
                 return SERVICE_TYPE_RULES_NAME
 
         return None
-    elif rule.rule_type in set(
-        [
-            RuleType.ATTRIBUTE.value,
-            RuleType.EXPANDATTRIBUTE.value,
-            'hal_attribute',
-        ]
-    ):
+    elif rule.rule_type in ATTRIBUTE_RULE_TYPES:
         return ATTRIBUTE_RULES_NAME
     elif isinstance(rule.parts[0], str):
         if rule.parts[0].endswith('_prop'):
@@ -181,22 +229,84 @@ def group_rules(mld: MultiLevelDict[Rule]):
 def rules_sort_key(rule: Rule):
     # Put type rules at the beginning
     if rule.rule_type == RuleType.TYPE.value:
-        return (False, ['0'])
+        return (False, ('0',))
 
-    compare_values = [str(h) for h in rule.hash_values]
-    return (not rule.is_macro, compare_values)
+    return (not rule.is_macro, rule.sort_values())
+
+
+def output_rules(name: str, rules: Set[Rule], output_dir: str):
+    sorted_rules = sorted(rules, key=rules_sort_key)
+
+    lines: List[str] = []
+    last_type = None
+    for rule in sorted_rules:
+        if last_type is not None and rule.rule_type != last_type:
+            lines.append('\n')
+        last_type = rule.rule_type
+        lines.append(f'{rule}\n')
+
+    output_path = Path(output_dir, name)
+    write_text_if_changed(output_path, ''.join(lines))
 
 
 def output_grouped_rules(grouped_rules: Dict[str, Set[Rule]], output_dir: str):
     for name, rules in grouped_rules.items():
-        sorted_rules = sorted(rules, key=rules_sort_key)
+        output_rules(name, rules, output_dir)
 
-        output_path = Path(output_dir, name)
-        with open(output_path, 'w') as o:
-            last_type = None
-            for rule in sorted_rules:
-                if last_type is not None and rule.rule_type != last_type:
-                    o.write('\n')
-                last_type = rule.rule_type
-                o.write(str(rule))
-                o.write('\n')
+    return set(grouped_rules.keys())
+
+
+# Grouped rules shared with the worker processes, inherited through fork
+# to avoid serializing them for each file
+shared_grouped_rules: Optional[Dict[str, Set[Rule]]] = None
+
+
+def output_rules_worker(name: str, output_dir: str):
+    assert shared_grouped_rules is not None
+
+    output_rules(name, shared_grouped_rules[name], output_dir)
+
+
+def output_policy(
+    selinux_dir: Optional[str],
+    genfs_rules: List[Rule],
+    grouped_rules: Dict[str, Set[Rule]],
+    output_dir: str,
+    jobs: int = 1,
+):
+    if jobs <= 1:
+        names: Set[str] = set()
+        names.update(output_contexts(selinux_dir, output_dir))
+        names.update(output_genfs_contexts(genfs_rules, output_dir))
+        names.update(output_grouped_rules(grouped_rules, output_dir))
+        return names
+
+    global shared_grouped_rules
+    shared_grouped_rules = grouped_rules
+
+    # Files are independent of eachother, sort, format and write them in
+    # parallel, contexts first since they are the largest
+    names_input_paths = find_contexts(selinux_dir)
+    try:
+        with process_pool(jobs) as executor:
+            futures: List[Future[None]] = []
+            for name, input_path in names_input_paths:
+                output_path = str(Path(output_dir, name))
+                future = executor.submit(copy_contexts, input_path, output_path)
+                futures.append(future)
+
+            for name in grouped_rules:
+                future = executor.submit(output_rules_worker, name, output_dir)
+                futures.append(future)
+
+            names = output_genfs_contexts(genfs_rules, output_dir)
+
+            for future in futures:
+                future.result()
+    finally:
+        shared_grouped_rules = None
+
+    names.update(name for name, _ in names_input_paths)
+    names.update(grouped_rules.keys())
+
+    return names
@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+
+def peak_rss(who: int):
+    max_rss = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return max_rss
+
+    return max_rss * 1024
+
+
+def cpu_time(who: int):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class PhaseStats:
+    def __init__(
+        self,
+        name: str,
+        wall_time: float,
+        cpu_time: float,
+        children_cpu_time: float,
+        peak_rss_so_far: int,
+        children_peak_rss_so_far: int,
+    ):
+        self.name = name
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.children_cpu_time = children_cpu_time
+        # Peak RSS can only be measured for the whole process, these are
+        # the peaks reached since the start of the process, not during this
+        # phase, later phases keep the value of the largest phase before
+        self.peak_rss_so_far = peak_rss_so_far
+        self.children_peak_rss_so_far = children_peak_rss_so_far
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'children_cpu_time': self.children_cpu_time,
+            'peak_rss_so_far': self.peak_rss_so_far,
+            'children_peak_rss_so_far': self.children_peak_rss_so_far,
+        }
+
+
+class PhaseProfiler:
+    def __init__(self, enabled: bool = True):
+        self.__enabled = enabled
+        self.__phases: List[PhaseStats] = []
+        # Reports of the policies decompiled in batch mode, by policy name
+        self.__policy_reports: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.__enabled:
+            yield
+            return
+
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time(resource.RUSAGE_SELF)
+        children_cpu_start = cpu_time(resource.RUSAGE_CHILDREN)
+
+        try:
+            yield
+        finally:
+            # Record the peak RSS reached so far at the end of each phase
+            stats = PhaseStats(
+                name,
+                time.perf_counter() - wall_start,
+                cpu_time(resource.RUSAGE_SELF) - cpu_start,
+                cpu_time(resource.RUSAGE_CHILDREN) - children_cpu_start,
+                peak_rss(resource.RUSAGE_SELF),
+                peak_rss(resource.RUSAGE_CHILDREN),
+            )
+            self.__phases.append(stats)
+
+    def add_policy_report(self, name: str, report: Dict[str, Any]):
+        self.__policy_reports[name] = report
+
+    def report(self):
+        report: Dict[str, Any] = {
+            'phases': [p.to_json() for p in self.__phases],
+            'wall_time': sum(p.wall_time for p in self.__phases),
+            'cpu_time': sum(p.cpu_time for p in self.__phases),
+            'peak_rss': peak_rss(resource.RUSAGE_SELF),
+        }
+
+        if self.__policy_reports:
+            report['policies'] = self.__policy_reports
+
+        return report
+
+    def write_report(self, path: str):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=4)
+            file.write('\n')
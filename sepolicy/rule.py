@@ -4,8 +4,10 @@
 from __future__ import annotations
 
 import re
+import sys
 from enum import Enum
-from typing import Generator, Iterable, List, Optional, Tuple, Union
+from functools import cache
+from typing import Generator, List, Optional, Tuple, Union
 
 from class_set import ClassSet
 from conditional_type import IConditionalType
@@ -28,6 +30,27 @@ def is_type_generated(part: rule_part):
     return part.startswith('base_typeattr_')
 
 
+def intern_part(part: rule_part) -> rule_part:
+    if isinstance(part, str):
+        return sys.intern(part)
+
+    return part
+
+
+@cache
+def unpack_line_regex(open_char: str, close_char: str, separators: str):
+    # Match brackets one by one and everything between brackets and
+    # separators as a single token, separators are skipped by findall
+    brackets = re.escape(f'{open_char}{close_char}')
+    special = re.escape(f'{open_char}{close_char}{separators}')
+    return re.compile(f'[{brackets}]|[^{special}]+')
+
+
+@cache
+def unpack_line_ignored_table(ignored_chars: str):
+    return str.maketrans('', '', ignored_chars)
+
+
 def unpack_line(
     rule: str,
     open_char: str,
@@ -40,35 +63,24 @@ def unpack_line(
 
     stack: List[raw_parts_list] = []
     current: raw_parts_list = []
-    token = ''
 
-    def add_token():
-        nonlocal token
-
-        if token:
-            current.append(token)
-            token = ''
+    if ignored_chars:
+        rule = rule.translate(unpack_line_ignored_table(ignored_chars))
 
     if open_by_default:
         rule = f'{open_char}{rule}{close_char}'
 
-    for c in rule:
-        if c in ignored_chars:
-            continue
-
-        if c == open_char:
-            add_token()
+    regex = unpack_line_regex(open_char, close_char, separators)
+    for token in regex.findall(rule):
+        if token == open_char:
             stack.append(current)
             current = []
-        elif c == close_char:
-            add_token()
+        elif token == close_char:
             last = stack.pop()
             last.append(current)
             current = last
-        elif c in separators:
-            add_token()
         else:
-            token += c
+            current.append(token)
 
     assert isinstance(current[0], list)
 
@@ -89,10 +101,6 @@ def flatten_parts(parts: raw_part) -> Generator[str, None, None]:
             yield part
 
 
-def remove_ioctl_zeros(ioctls: Iterable[str]):
-    return list(map(lambda i: hex(int(i, base=16)), ioctls))
-
-
 class RuleType(str, Enum):
     ALLOW = 'allow'
     ALLOWXPERM = 'allowxperm'
@@ -204,6 +212,17 @@ def format_rule(rule: Rule):
 
 
 class Rule:
+    __slots__ = (
+        'rule_type',
+        'parts',
+        'varargs',
+        'is_macro',
+        'hash_values',
+        '__hash',
+        '__str',
+        '__sort_values',
+    )
+
     def __init__(
         self,
         rule_type: str,
@@ -211,20 +230,35 @@ class Rule:
         varargs: Tuple[str, ...],
         is_macro: bool = False,
     ):
-        self.rule_type = rule_type
-        self.parts = parts
-        self.varargs = varargs
+        # Intern the names so that all the rules and the MultiLevelDict keys
+        # share a single copy of each of them, and so that comparing keys
+        # can be done by identity
+        self.rule_type = sys.intern(rule_type)
+        self.parts = tuple(map(intern_part, parts))
+        self.varargs = tuple(map(sys.intern, varargs))
         self.is_macro = is_macro
         self.hash_values: Tuple[rule_part_or_varargs, ...] = tuple(
             [self.rule_type] + list(self.parts) + [self.varargs]
         )
 
-        # Postpone hash calculation so that ConditionalTypes are fully
-        # gathered and ConditionalTypeRedirect can find them
+        # Postpone hash calculation, not all rules end up being hashed
         self.__hash: Optional[int] = None
 
+        # Formatting conditional types is slow, only do it once per rule
+        self.__str: Optional[str] = None
+        self.__sort_values: Optional[Tuple[str, ...]] = None
+
     def __str__(self):
-        return format_rule(self)
+        if self.__str is None:
+            self.__str = format_rule(self)
+
+        return self.__str
+
+    def sort_values(self):
+        if self.__sort_values is None:
+            self.__sort_values = tuple(str(h) for h in self.hash_values)
+
+        return self.__sort_values
 
     def __eq__(self, other: object):
         assert isinstance(other, Rule)
@@ -7,13 +7,13 @@ from typing import List
 
 from classmap import Classmap
 from conditional_type import ConditionalType
+from ioctl_set import IoctlSet
 from rule import (
     Rule,
     RuleType,
     flatten_parts,
     raw_part,
     raw_parts_list,
-    remove_ioctl_zeros,
     unpack_line,
 )
 
@@ -48,6 +48,8 @@ def structure_conditional_type(parts: raw_part):
 
 
 class SourceRule(Rule):
+    __slots__ = ()
+
     @classmethod
     def from_line(cls, line: str, classmap: Classmap) -> List[Rule]:
         parts = unpack_line(
@@ -134,13 +136,13 @@ class SourceRule(Rule):
                 assert isinstance(parts[4], str), line
                 assert parts[4] == 'ioctl'
 
-                varargs = list(flatten_parts(parts[5]))
-                ioctls = remove_ioctl_zeros(varargs)
+                # Use the same canonical ranges as the CIL rules
+                ioctl_set = IoctlSet.from_strs(flatten_parts(parts[5]))
 
                 rule = Rule(
                     parts[0],
                     (parts[1], parts[2], parts[3]),
-                    tuple(ioctls),
+                    ioctl_set.to_strs(),
                 )
                 rules.append(rule)
             case RuleType.ATTRIBUTE.value:
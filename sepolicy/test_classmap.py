@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: 2025 The LineageOS Project
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import annotations
+
+import shutil
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from classmap import CLASSMAP_H_NAME, extract_classmap, parse_classmap
+
+# Trimmed down version of security/selinux/include/classmap.h, keeping the
+# constructs that the parser has to handle
+CLASSMAP_H = r"""/* SPDX-License-Identifier: GPL-2.0 */
+#define CAP_LAST_CAP 31
+#define CAP_SETFCAP 31
+
+#define COMMON_FILE_SOCK_PERMS                                            \
+	"ioctl", "read", "write", "create", "getattr", "setattr", "lock", \
+		"relabelfrom", "relabelto", "append", "map"
+
+#define COMMON_FILE_PERMS                                                 \
+	COMMON_FILE_SOCK_PERMS, "unlink", "link", "rename", "execute",    \
+		"quotaon", /* "quotaoff" was removed */ "mounton",        \
+		"audit_access", "open", "execmod", "watch",               \
+		"watch_mount", "watch_sb", "watch_with_perm", "watch_reads"
+
+#define COMMON_SOCK_PERMS                                              \
+	COMMON_FILE_SOCK_PERMS, "bind", "connect", "listen", "accept", \
+		"getopt", "setopt", "shutdown", "recvfrom", "sendto",  \
+		"name_bind"
+
+/* Defines inside comments are skipped
+#define COMMON_IPC_PERMS "ignored"
+*/
+#define COMMON_IPC_PERMS \
+	"create", "destroy", "getattr", "setattr", "read", "write", \
+		"associate", "unix_read", "unix_write"
+
+#define COMMON_CAP_PERMS                                                     \
+	"chown", "dac_override", "dac_read_search", "fowner", "fsetid",      \
+		"kill", "setgid", "setuid", "setpcap", "linux_immutable",    \
+		"net_bind_service", "net_broadcast", "net_admin", "net_raw", \
+		"ipc_lock", "ipc_owner", "sys_module", "sys_rawio",          \
+		"sys_chroot", "sys_ptrace", "sys_pacct", "sys_admin",        \
+		"sys_boot", "sys_nice", "sys_resource", "sys_time",          \
+		"sys_tty_config", "mknod", "lease", "audit_write",           \
+		"audit_control", "setfcap"
+
+#if CAP_LAST_CAP > CAP_SETFCAP
+#error New capability defined, please update COMMON_CAP2_PERMS.
+#endif
+
+/*
+ * Note: The name for any socket class should be suffixed by "socket",
+ *	 and doesn't contain more than one substr of "socket".
+ */
+const struct security_class_mapping secclass_map[] = {
+	{ "security",
+	  { "compute_av", "compute_create", "compute_member",
+	    "check_context", "load_policy", "compute_relabel",
+	    "compute_user", "setenforce", "setbool", "setsecparam",
+	    "setcheckreqprot", "read_policy", "validate_trans", NULL } },
+	{ "process",
+	  { "fork",	  "transition",	  "sigchld", // commonly granted
+	    "sigkill", "sigstop", "signull", "signal", "ptrace",
+	    "getsched", "setsched", "getsession", "getpgid", "setpgid",
+	    "getcap", "setcap", "share", "getattr", "setexec",
+	    "setfscreate", "noatsecure", "siginh", "setrlimit",
+	    "rlimitinh", "dyntransition", "setcurrent", "execmem",
+	    "execstack", "execheap", "setkeycreate", "setsockcreate",
+	    "getrlimit", NULL } },
+	{ "file",
+	  { COMMON_FILE_PERMS, "execute_no_trans", "entrypoint", NULL } },
+	{ "dir",
+	  { COMMON_FILE_PERMS, "add_name", "remove_name", "reparent",
+	    "search", "rmdir", NULL } },
+	{ "fd", { "use", NULL } },
+	{ "socket", { COMMON_SOCK_PERMS, NULL } },
+	{ "tcp_socket", { COMMON_SOCK_PERMS, "node_bind", "name_connect", NULL } },
+	{ "sem", { COMMON_IPC_PERMS, NULL } },
+	{ "capability", { COMMON_CAP_PERMS, NULL } },
+	{ "lockdown", { "integrity", "confidentiality", NULL } },
+	{ "user_namespace", { "create", NULL } },
+	{ NULL }
+};
+
+#if PF_MAX > 46
+#error New address family defined, please update secclass_map.
+#endif
+"""
+
+
+class ClassmapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.selinux_include_path = self.tmp_dir.name
+        Path(self.selinux_include_path, CLASSMAP_H_NAME).write_text(CLASSMAP_H)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_parse_classmap(self):
+        class_perms_map = parse_classmap(self.selinux_include_path)
+
+        self.assertEqual(
+            list(class_perms_map.keys())[:3],
+            ['security', 'process', 'file'],
+        )
+        self.assertEqual(class_perms_map['fd'], ['use'])
+        self.assertEqual(
+            class_perms_map['file'][:3],
+            ['ioctl', 'read', 'write'],
+        )
+        self.assertNotIn('quotaoff', class_perms_map['file'])
+        self.assertEqual(
+            class_perms_map['file'][-2:],
+            ['execute_no_trans', 'entrypoint'],
+        )
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'gcc is not available')
+    def test_parse_classmap_matches_gcc(self):
+        parsed_class_perms_map = parse_classmap(self.selinux_include_path)
+        extracted_class_perms_map = extract_classmap(self.selinux_include_path)
+
+        # Classes and perms are sorted by their index, compare the order
+        # too, not only the contents
+        self.assertEqual(
+            list(parsed_class_perms_map.items()),
+            list(extracted_class_perms_map.items()),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,27 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+import logging
+import multiprocessing
+import sys
 from collections.abc import Hashable
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from logging.handlers import MemoryHandler
+from multiprocessing.util import Finalize
 from typing import Any, Protocol, runtime_checkable
 
+LOG_BUFFER_CAPACITY = 1024
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+logger = logging.getLogger('sepolicy')
+
 
 @runtime_checkable
 class SizedIndexable(Hashable, Protocol):
@@ -31,6 +48,7 @@ def split_normalize_text(text: str):
     lines = list(filter(lambda line: not is_empty_line(line), lines))
     return lines
 
+
 class Color(str, Enum):
     RED = '\033[0;31m'
     GREEN = '\033[0;32m'
@@ -38,7 +56,54 @@ class Color(str, Enum):
     END = '\033[0m'
 
 
-def color_print(*args: object, color: Color):
+def setup_logging(level: int, buffered: bool = True):
+    handler: logging.Handler = logging.StreamHandler(sys.stdout)
+
+    # Write messages in batches instead of one line at a time, errors are
+    # written out immediately
+    if buffered:
+        handler = MemoryHandler(
+            LOG_BUFFER_CAPACITY,
+            flushLevel=logging.ERROR,
+            target=handler,
+        )
+
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def flush_logging():
+    # Must also be called before forking to not duplicate buffered messages
+    # in the child processes, and by child processes before returning
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def process_pool_initializer():
+    # Pool workers exit without running the atexit hooks, flush the
+    # messages they buffered from the multiprocessing exit handlers instead
+    Finalize(None, flush_logging, exitpriority=0)
+
+
+def process_pool(jobs: int):
+    # Fork so that the workers inherit the logging setup, the hash seed
+    # used by the objects that cache their hashes and the module globals
+    # used to share data with them
+    flush_logging()
+
+    return ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=process_pool_initializer,
+    )
+
+
+def color_print(*args: object, color: Color, level: int = logging.INFO):
+    # Avoid formatting messages that are not going to be shown
+    if not logger.isEnabledFor(level):
+        return
+
     args_str = ' '.join(str(arg) for arg in args)
     args_str = color.value + args_str + Color.END.value
-    print(args_str)
+    logger.log(level, args_str)
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
+import logging
 import os
 import sys
 import fdt
 from fdt import PropStrings, PropWords
 from fdt_extra import PropWordsWithPhandles
+from logging.handlers import MemoryHandler
+
+LOG_BUFFER_CAPACITY = 1024
+
+log = logging.getLogger(__name__)
 
 def for_each_node(node, fn, *args, max_recurse_level=-1, recurse_level=0, **kwargs):
     if node is None:
@@ -23,7 +29,7 @@ def for_each_node(node, fn, *args, max_recurse_level=-1, recurse_level=0, **kwar
             **kwargs)
 
 def replace_phandle_with_label(path, name, addr, label=None, phandle_labels_map=None):
-    print(f'Replace phandle {path} {name} {addr} {label}')
+    log.debug('Replace phandle %s %s %s %s', path, name, addr, label)
     index = addr // 4
     node = dt.get_node(path)
     ref_prop = node.get_property(name)
@@ -40,7 +46,7 @@ def replace_phandle_with_label(path, name, addr, label=None, phandle_labels_map=
     if not label:
         phandle = new_prop.data[index]
         if phandle not in phandle_labels_map:
-            print(f'Invalid phandle {phandle}')
+            log.warning('Invalid phandle %s', phandle)
             return
 
         label = phandle_labels_map[phandle][0]
@@ -54,7 +60,7 @@ def dt_fill_fixups(dt):
 
     for prop in fixups_node.props:
         for value in prop.data:
-            print(f'Fixup prop {prop} {value}')
+            log.debug('Fixup prop %s %s', prop, value)
             node_path, prop_name, prop_data_index = value.split(':')
             prop_data_index = int(prop_data_index)
 
@@ -102,7 +108,7 @@ def dt_fill_symbols(dt):
             abs_node_path = prop.path.removeprefix(f'/{LOCAL_FIXUPS}')
 
             for value in prop.data:
-                print(f'Fixup prop {prop} {value}')
+                log.debug('Fixup prop %s %s', prop, value)
                 replace_phandle_with_label(abs_node_path, prop.name, value,
                     phandle_labels_map=phandle_labels_map)
 
@@ -170,7 +176,40 @@ def remove_phandle(node):
 def dt_remove_phandles(dt):
     for_each_node(dt.root, remove_phandle)
 
+def parse_log_level(log_level):
+    if log_level.isdigit():
+        return int(log_level)
+
+    level = logging.getLevelName(log_level.upper())
+    if not isinstance(level, int):
+        raise ValueError(log_level)
+
+    return level
+
+def setup_logging(level):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    # Write messages in batches instead of one line at a time, the buffer
+    # is flushed by logging.shutdown() at exit
+    buffered_handler = MemoryHandler(
+        LOG_BUFFER_CAPACITY,
+        flushLevel=logging.ERROR,
+        target=handler,
+    )
+
+    logging.basicConfig(level=level, handlers=[buffered_handler])
+
 if __name__ == '__main__':
+    # Per-node messages are only formatted when asked for with
+    # SORT_DTS_LOG_LEVEL=debug, and are written in batches
+    log_level = os.environ.get('SORT_DTS_LOG_LEVEL') or 'warning'
+    try:
+        setup_logging(parse_log_level(log_level))
+    except ValueError:
+        sys.exit(f'Invalid SORT_DTS_LOG_LEVEL {log_level!r}, expected '
+                 'critical, error, warning, info, debug or a number')
+
     if len(sys.argv) < 2:
         sys.exit(1)
 